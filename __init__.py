@@ -1,4 +1,5 @@
-from .fcb import FcbSurface
-
 def create_instance(c_instance):
+	# imported here so the package's offline tools (see snapshot.py) can be
+	# imported without Live
+	from .fcb import FcbSurface
 	return FcbSurface(c_instance)
\ No newline at end of file
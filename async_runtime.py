@@ -0,0 +1,337 @@
+from .footswitch import FootSwitch, EventType, Layout, Debouncer, ComboDetector, DEBOUNCE_WINDOW, \
+	CC_BYTE, DOWN_BYTE, UP_BYTE, LEFT_EXPR_BYTE, RIGHT_EXPR_BYTE, dispatch, value_to_switch, switch_to_value
+from .gestures import GestureProfile
+from .led import LEDController, command, SLOW_BLINK
+from .metrics import metrics, switch_event_index, EXPRESSION_CC
+from collections import deque
+from functools import partial
+from time import monotonic
+import asyncio
+import logging
+import threading
+import traceback
+
+logger = logging.getLogger(__name__)
+
+class AsyncRuntime:
+	"""
+	Runs the footswitch event bus, gesture timers, LED blinking and MIDI
+	output as coroutines on one asyncio loop in a single background thread,
+	instead of a thread per footswitch and per blinking LED.
+
+	Work meant for Live's main thread is handed over through a queue that
+	the control surface drains from update_display (see schedule_message).
+	"""
+	def __init__(self):
+		self._loop = asyncio.new_event_loop()
+		self._output = None
+		self._main_thread_queue = deque()
+		self._ready = threading.Event()
+		self._thread = threading.Thread(target=self.run, daemon=True)
+		self._thread.start()
+		self._ready.wait()
+
+	def run(self):
+		asyncio.set_event_loop(self._loop)
+		self._output = asyncio.Queue()
+		self._loop.create_task(self._drain_output())
+		self._loop.call_soon(self._ready.set)
+		self._loop.run_forever()
+		# let the gesture, blink and output tasks unwind before the loop goes
+		tasks = asyncio.all_tasks(self._loop)
+		for task in tasks:
+			task.cancel()
+		self._loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+		logger.info("Async runtime stopped")
+
+	def stop(self):
+		self._loop.call_soon_threadsafe(self._loop.stop)
+		if threading.current_thread() is not self._thread:
+			self._thread.join(1.0)
+
+	def call_soon(self, fn, *a):
+		"""Runs fn(*a) on the loop, in the order calls were made"""
+		if threading.current_thread() is self._thread:
+			self._loop.call_soon(fn, *a)
+		else:
+			self._loop.call_soon_threadsafe(fn, *a)
+
+	def spawn(self, coroutine):
+		"""Starts a task from the loop thread"""
+		return self._loop.create_task(coroutine)
+
+	def output(self, fn, *a):
+		"""Queues a MIDI send. Sends go out in order from a single coroutine."""
+		self.call_soon(self._output.put_nowait, partial(fn, *a))
+
+	def output_depth(self) -> int:
+		return self._output.qsize()
+
+	def schedule_message(self, delay, callback):
+		"""Drop-in for ControlSurface.schedule_message: delay counts drain() calls"""
+		self._main_thread_queue.append([delay, callback])
+
+	def drain(self):
+		"""Runs the work handed to Live's main thread. Call it from the main thread."""
+		for _ in range(len(self._main_thread_queue)):
+			item = self._main_thread_queue.popleft()
+			if item[0] > 0:
+				item[0] -= 1
+				self._main_thread_queue.append(item)
+				continue
+			try:
+				item[1]()
+			except Exception:
+				logger.error("Caught exception in main thread callback: {}".format(traceback.format_exc()))
+
+	async def _drain_output(self):
+		while True:
+			send = await self._output.get()
+			try:
+				send()
+			except Exception:
+				logger.error("Caught exception sending MIDI: {}".format(traceback.format_exc()))
+
+class AsyncFootSwitchEventBus:
+	"""
+	Same interface as FootSwitchEventBus, with each footswitch's gesture
+	detection running as a coroutine on the AsyncRuntime's loop.
+	"""
+	def __init__(self, runtime: AsyncRuntime, debounce_window = DEBOUNCE_WINDOW, profile: GestureProfile = None):
+		self._runtime = runtime
+		self._debouncer = Debouncer(debounce_window)
+		self._profile = profile if profile is not None else GestureProfile()
+		self._switches = {}
+		self._combos = None
+		self._left_expression = self._noop
+		self._right_expression = self._noop
+		ready = threading.Event()
+		def start():
+			for switch in FootSwitch:
+				self._switches[switch] = SwitchState(switch)
+				runtime.spawn(self._gestures(self._switches[switch]))
+			self._combos = AsyncComboDetector(self._forward, runtime)
+			ready.set()
+		runtime.call_soon(start)
+		ready.wait()
+
+	def set_debounce(self, footswitch: FootSwitch, window: float):
+		self._debouncer.set_window(footswitch, window)
+
+	def debouncer(self):
+		return self._debouncer
+
+	def profile(self) -> GestureProfile:
+		return self._profile
+
+	def install(self, layout: Layout):
+		for footswitch, cb_map in layout.get_callbacks().items():
+			for event_type, cb in cb_map.items():
+				self._switches[footswitch].callbacks[event_type] = cb
+		for combo in layout.get_combos():
+			self._runtime.call_soon(self._combos.add, combo)
+		if layout.left_expression_callback() is not None:
+			self._left_expression = layout.left_expression_callback()
+		if layout.right_expression_callback() is not None:
+			self._right_expression = layout.right_expression_callback()
+
+	def uninstall(self, layout: Layout):
+		for footswitch, cb_map in layout.get_callbacks().items():
+			for event_type in cb_map.keys():
+				self._switches[footswitch].callbacks.pop(event_type, None)
+		for combo in layout.get_combos():
+			self._runtime.call_soon(self._combos.remove, combo)
+		if layout.left_expression_callback() is not None:
+			self._left_expression = self._noop
+		if layout.right_expression_callback() is not None:
+			self._right_expression = self._noop
+
+	def midi_callback(self, byte1, byte2, byte3, *a):
+		if byte1 == CC_BYTE:
+			if byte2 == DOWN_BYTE:
+				now = monotonic()
+				if self._debouncer.accept(byte3, True, now):
+					self._runtime.call_soon(self._edge, byte3, True, now)
+			elif byte2 == UP_BYTE:
+				now = monotonic()
+				if self._debouncer.accept(byte3, False, now):
+					self._runtime.call_soon(self._edge, byte3, False, now)
+			elif byte2 == LEFT_EXPR_BYTE:
+				metrics.count(EXPRESSION_CC)
+				self._runtime.call_soon(self._left_expression, byte3)
+			elif byte2 == RIGHT_EXPR_BYTE:
+				metrics.count(EXPRESSION_CC)
+				self._runtime.call_soon(self._right_expression, byte3)
+
+	def _edge(self, value, down, arrival):
+		if self._combos.intercepts(value):
+			self._combos.edge(value, down, arrival)
+		else:
+			self._forward(value, down, arrival)
+
+	def _forward(self, value, down, arrival):
+		if down:
+			self._switches[value_to_switch(value)].down(arrival)
+		else:
+			self._switches[value_to_switch(value)].up(arrival)
+
+	async def _gestures(self, state):
+		"""The same state machine as Notifier.run"""
+		profile = self._profile
+		missed_gap = None
+		while True:
+			await state.await_down()
+			if missed_gap is not None:
+				profile.record_gap(state.value, state.down_time - missed_gap)
+				missed_gap = None
+			if not await state.await_up(profile.long_press_duration(state.value)):
+				state.notify(EventType.LONG_PRESS)
+				await state.await_up()
+				profile.record_press(state.value, state.up_time - state.down_time)
+				continue
+
+			profile.record_press(state.value, state.up_time - state.down_time)
+			press_event = EventType.PRESS
+
+			if EventType.DOUBLE_PRESS in state.callbacks:
+				released = state.up_time
+				if await state.await_down(profile.double_press_duration(state.value)):
+					profile.record_gap(state.value, state.down_time - released)
+					press_event = EventType.DOUBLE_PRESS
+					await state.await_up()
+				else:
+					missed_gap = released
+
+			state.notify(press_event)
+
+	def _noop(self, val):
+		pass
+
+class AsyncComboDetector(ComboDetector):
+	"""
+	ComboDetector whose hold window runs as a task on the AsyncRuntime's loop
+	instead of on a thread. Create it, and call add, remove and edge, on the
+	loop thread.
+	"""
+	def __init__(self, forward, runtime: AsyncRuntime):
+		self._runtime = runtime
+		super(AsyncComboDetector, self).__init__(forward)
+
+	def _start(self):
+		self._wake = asyncio.Event()
+		self._runtime.spawn(self._run())
+
+	async def _run(self):
+		while True:
+			deadline = self.step()
+			try:
+				await asyncio.wait_for(self._wake.wait(), None if deadline is None else max(0, deadline - monotonic()))
+			except asyncio.TimeoutError:
+				pass
+			self._wake.clear()
+
+class SwitchState:
+	"""Per-footswitch state of the async event bus. Only touched on the loop thread."""
+	def __init__(self, switch: FootSwitch):
+		self.callbacks = {}
+		self.value = switch_to_value(switch)
+		self._metric_base = switch_event_index(switch.value, 1) - 1
+		self._down_event = asyncio.Event()
+		self._up_event = asyncio.Event()
+		self.down_time = 0.0
+		self.up_time = 0.0
+
+	def down(self, arrival):
+		self.down_time = arrival
+		self._down_event.set()
+
+	def up(self, arrival):
+		self.up_time = arrival
+		self._up_event.set()
+
+	async def await_down(self, timeout = None):
+		down = await self._wait(self._down_event, timeout)
+		if down:
+			self.notify(EventType.DOWN)
+			self._down_event.clear()
+		return down
+
+	async def await_up(self, timeout = None):
+		up = await self._wait(self._up_event, timeout)
+		if up:
+			self.notify(EventType.UP)
+			self._up_event.clear()
+		return up
+
+	async def _wait(self, event, timeout):
+		if timeout is None:
+			await event.wait()
+			return True
+		try:
+			await asyncio.wait_for(event.wait(), timeout)
+			return True
+		except asyncio.TimeoutError:
+			return False
+
+	def notify(self, event_type):
+		metrics.count(self._metric_base + event_type.value)
+		dispatch(self.callbacks, event_type, self.up_time if event_type is EventType.UP else self.down_time)
+
+class AsyncLEDController(LEDController):
+	"""
+	LEDController whose CCs go through the runtime's output queue and whose
+	blinking runs as a task on the loop. Killing a blink and sending the next
+	command are both queued on the loop, so they can't interleave.
+	"""
+	def __init__(self, send_cc, runtime: AsyncRuntime, is_active = True, initialize_off = []):
+		self._runtime = runtime
+		self._blinks = {}
+		super(AsyncLEDController, self).__init__(send_cc, is_active, initialize_off)
+
+	def copy(self, initialize_off = []):
+		return AsyncLEDController(self._send_cc, self._runtime, False, initialize_off)
+
+	@command
+	def blink_on(self, value, speed = SLOW_BLINK):
+		self._kill(value)
+		self._runtime.call_soon(self._start_blink, value, speed, True)
+
+	@command
+	def blink_off(self, value, speed = SLOW_BLINK):
+		self._kill(value)
+		self._runtime.call_soon(self._start_blink, value, speed, False)
+
+	def deactivate(self):
+		self._is_active = False
+		self._runtime.call_soon(self._cancel_all)
+
+	def _on(self, value):
+		self._runtime.output(super(AsyncLEDController, self)._on, value)
+
+	def _off(self, value):
+		self._runtime.output(super(AsyncLEDController, self)._off, value)
+
+	def _start_blink(self, value, speed, on):
+		self._cancel(value)
+		self._blinks[value] = self._runtime.spawn(self._blink_task(value, speed, on))
+
+	async def _blink_task(self, value, speed, on):
+		cb1 = self._on if on else self._off
+		cb2 = self._off if on else self._on
+		while True:
+			cb1(value)
+			await asyncio.sleep(.1)
+			cb2(value)
+			await asyncio.sleep(speed)
+
+	def _kill(self, value):
+		self._runtime.call_soon(self._cancel, value)
+
+	def _cancel(self, value):
+		task = self._blinks.pop(value, None)
+		if task is not None:
+			task.cancel()
+
+	def _cancel_all(self):
+		for value in list(self._blinks.keys()):
+			self._cancel(value)
@@ -0,0 +1,303 @@
+"""
+Benchmarks and accuracy checks, run in virtual time against the stand-in
+Live from snapshot.py:
+
+	python -m fcb.bench taps engines undo
+
+Each one prints its numbers and exits non-zero when its check fails. Like
+soak.py, nothing is imported from the rest of the package until the
+stand-in Live is installed.
+"""
+from . import snapshot
+from contextlib import contextmanager
+import argparse
+import logging
+import random
+import statistics
+import sys
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+class BenchFailure(Exception):
+	pass
+
+def _install(song = None):
+	snapshot.install(song if song is not None else snapshot.Song())
+
+def jittered_taps(rng, tempo: float, taps: int, jitter: float):
+	"""Tap times for taps at tempo, each off by a gaussian jitter (seconds)"""
+	interval = 60.0 / tempo
+	return sorted(i * interval + rng.gauss(0.0, jitter) for i in range(taps))
+
+def last_three_taps(times):
+	"""The tempo the metronome used to set: two intervals over the last three taps"""
+	return 120 / (times[-1] - times[-3])
+
+def taps(trials: int = 200, count: int = 12, jitters = (0.005, 0.01, 0.02, 0.04), seed: int = 0):
+	"""
+	Mean tempo error of TapTempo and of the last three taps over jittered tap
+	streams at 70-170 BPM. Raises BenchFailure if TapTempo is less accurate
+	than the last three taps at any jitter of 10 ms or more.
+	"""
+	_install()
+	from .transport import TapTempo
+
+	rng = random.Random(seed)
+	results = []
+	for jitter in jitters:
+		median_error = 0.0
+		last_three_error = 0.0
+		tapped = 0
+		elapsed = 0.0
+		for _ in range(trials):
+			tempo = rng.uniform(70.0, 170.0)
+			times = jittered_taps(rng, tempo, count, jitter)
+			estimator = TapTempo()
+			started = time.perf_counter()
+			for t in times:
+				estimate = estimator.tap(t)
+			elapsed += time.perf_counter() - started
+			tapped += len(times)
+			median_error += abs(estimate - tempo)
+			last_three_error += abs(last_three_taps(times) - tempo)
+		results.append((jitter, median_error / trials, last_three_error / trials, elapsed / tapped * 1e6))
+
+	print("jitter  median  last 3  us/tap")
+	for jitter, median_error, last_three_error, per_tap in results:
+		print("{:4.0f}ms  {:6.2f}  {:6.2f}  {:6.2f}".format(jitter * 1000, median_error, last_three_error, per_tap))
+	for jitter, median_error, last_three_error, _ in results:
+		if jitter >= 0.01 and median_error >= last_three_error:
+			raise BenchFailure("tap tempo off by {:.2f} BPM at {:.0f} ms jitter, the last three taps by {:.2f}".format(
+				median_error, jitter * 1000, last_three_error))
+	return results
+
+def _press_latency(bus, presses: int, gap: float):
+	"""Microseconds from each DOWN edge reaching midi_callback to its DOWN callback"""
+	from .footswitch import FootSwitch, EventType, Layout, CC_BYTE, DOWN_BYTE, UP_BYTE, DEBOUNCE_WINDOW, \
+		switch_to_value
+
+	latencies = []
+	called = threading.Event()
+	pressed = [0.0]
+	def down(*a):
+		latencies.append((time.perf_counter() - pressed[0]) * 1e6)
+		called.set()
+	layout = Layout()
+	layout.listen(FootSwitch.ONE, EventType.DOWN, down)
+	bus.install(layout)
+	value = switch_to_value(FootSwitch.ONE)
+	for _ in range(presses):
+		called.clear()
+		pressed[0] = time.perf_counter()
+		bus.midi_callback(CC_BYTE, DOWN_BYTE, value)
+		if not called.wait(1.0):
+			raise BenchFailure("a press wasn't delivered within 1s")
+		# held and released clear of the debounce window
+		time.sleep(DEBOUNCE_WINDOW + gap)
+		bus.midi_callback(CC_BYTE, UP_BYTE, value)
+		time.sleep(DEBOUNCE_WINDOW + gap)
+	bus.uninstall(layout)
+	return latencies
+
+def engines(presses: int = 300, gap: float = 0.005):
+	"""
+	DOWN edge to DOWN callback latency, jitter, CPU and threads of the
+	threaded engine and the asyncio runtime, in real time. Fails if either
+	drops a press.
+	"""
+	_install()
+	from .async_runtime import AsyncRuntime, AsyncFootSwitchEventBus
+	from .footswitch import FootSwitchEventBus
+
+	def threaded():
+		return FootSwitchEventBus(), lambda: None
+	def asyncio():
+		runtime = AsyncRuntime()
+		return AsyncFootSwitchEventBus(runtime), runtime.stop
+
+	print("engine    median   stdev     max  cpu ms  threads")
+	results = []
+	for name, make in (("threaded", threaded), ("asyncio", asyncio)):
+		threads = threading.active_count()
+		bus, stop = make()
+		threads = threading.active_count() - threads
+		cpu = time.process_time()
+		latencies = _press_latency(bus, presses, gap)
+		cpu = (time.process_time() - cpu) * 1000
+		stop()
+		results.append((name, statistics.median(latencies), statistics.pstdev(latencies), max(latencies), cpu, threads))
+		print("{:8s}  {:6.0f}  {:6.0f}  {:6.0f}  {:6.0f}  {:7d}".format(*results[-1]))
+	return results
+
+class UndoHistory:
+	"""
+	Counts the entries Live's undo history gets: one for every write outside
+	an undo step, and one for every undo step with writes in it.
+	"""
+	def __init__(self):
+		self._depth = 0
+		self._dirty = False
+		self.take()
+
+	def begin_undo_step(self):
+		self._depth += 1
+
+	def end_undo_step(self):
+		self._depth -= 1
+		if self._depth == 0 and self._dirty:
+			self._dirty = False
+			self.entries += 1
+
+	def written(self):
+		self.writes += 1
+		if self._depth > 0:
+			self._dirty = True
+		else:
+			self.entries += 1
+
+	def take(self):
+		"""(writes, undo entries) since the last take"""
+		counts = (getattr(self, "writes", 0), getattr(self, "entries", 0))
+		self.writes = 0
+		self.entries = 0
+		return counts
+
+class _Ungrouped:
+	"""In place of the UndoGrouper: every write is an undo entry of its own"""
+	@contextmanager
+	def group(self):
+		yield
+
+	def burst(self):
+		pass
+
+	def end_burst(self):
+		pass
+
+def undo(sweeps: int = 3, stomps: int = 20, patches: int = 10):
+	"""
+	Parameter writes and undo history entries of pedal sweeps, stomp presses
+	and patch changes on a rack track, with and without the UndoGrouper.
+	Fails if grouped gestures make more than one undo entry each.
+	"""
+	from .soak import generated_song
+	song = generated_song(songs=1, scenes=0, macros=[
+		"Drive #s1pt", "Boost #s1pt", "Tone #s1pt", "Wah #s5hel", "Volume #s5hel127-64", "Mix #s5hel0-100c2"])
+	track = song.tracks[0]
+	_install(song)
+	from . import expression, racks_controller
+	from .clock import VirtualClock
+	from .footswitch import FootSwitchEventBus, FootSwitch, CC_BYTE, DOWN_BYTE, UP_BYTE, LEFT_EXPR_BYTE, \
+		switch_to_value, top_row
+	from .led import LEDController
+	from .undo import UndoGrouper
+
+	history = UndoHistory()
+	song.begin_undo_step = history.begin_undo_step
+	song.end_undo_step = history.end_undo_step
+	initial = {}
+	for device in track.devices:
+		for p in device.parameters:
+			p.add_value_listener(history.written)
+			initial[p] = p.value
+
+	clock = VirtualClock()
+	main_thread = []
+	def step(seconds):
+		clock.settle()
+		while len(main_thread) > 0:
+			main_thread.pop(0)()
+		clock.advance(seconds)
+
+	bus = FootSwitchEventBus(clock=clock)
+	mode = racks_controller.RacksControllerMode(LEDController(lambda *a: None, False, clock=clock),
+		lambda delay, callback: main_thread.append(callback))
+	layout = [None]
+	def relayout():
+		if layout[0] is not None:
+			bus.uninstall(layout[0])
+		layout[0] = mode.get_layout()
+		bus.install(layout[0])
+	mode.set_layout_changed_callback(relayout)
+	mode.set_track(track)
+	relayout()
+
+	def press(footswitch, hold = 0.1):
+		bus.midi_callback(CC_BYTE, DOWN_BYTE, switch_to_value(footswitch))
+		step(hold)
+		bus.midi_callback(CC_BYTE, UP_BYTE, switch_to_value(footswitch))
+		step(0.5)
+
+	def sweep_pedal():
+		# hold stomp 5 to put its macros on the left pedal
+		press(FootSwitch.FIVE, 1.0)
+		for n in range(sweeps):
+			for value in range(0, 128, 2):
+				bus.midi_callback(CC_BYTE, LEFT_EXPR_BYTE, value if n % 2 == 0 else 127 - value)
+				step(0.01)
+			step(0.5)
+
+	def press_stomps():
+		for _ in range(stomps):
+			press(FootSwitch.ONE)
+
+	def change_patches():
+		for n in range(patches):
+			press(top_row()[(n + 1) % len(top_row())])
+
+	scenarios = (("sweeps", sweeps, sweep_pedal), ("stomps", stomps, press_stomps), ("patches", patches, change_patches))
+	results = []
+	original = racks_controller.undo_grouper
+	for name, grouper in (("ungrouped", _Ungrouped()), ("grouped", UndoGrouper(song, clock))):
+		expression.undo_grouper = grouper
+		racks_controller.undo_grouper = grouper
+		for scenario, gestures, play in scenarios:
+			step(1.0)
+			history.take()
+			play()
+			step(1.0)
+			writes, entries = history.take()
+			results.append((name, scenario, gestures, writes, entries))
+		grouper.end_burst()
+		for p, value in initial.items():
+			p.value = value
+		step(1.0)
+		history.take()
+	expression.undo_grouper = racks_controller.undo_grouper = original
+
+	print("           scenario  gestures  writes  undo entries")
+	for result in results:
+		print("{:9s}  {:8s}  {:8d}  {:6d}  {:12d}".format(*result))
+	for name, scenario, gestures, writes, entries in results:
+		if name == "grouped" and entries > gestures:
+			raise BenchFailure("{} {} made {} undo entries".format(gestures, scenario, entries))
+	return results
+
+BENCHES = {
+	"engines": engines,
+	"taps": taps,
+	"undo": undo,
+}
+
+def main(argv = None):
+	parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+	parser.add_argument("bench", nargs="*", help="benches to run: {} (default: all)".format(", ".join(sorted(BENCHES))))
+	args = parser.parse_args(argv)
+	unknown = [name for name in args.bench if name not in BENCHES]
+	if len(unknown) > 0:
+		parser.error("unknown bench {}".format(", ".join(unknown)))
+	logging.basicConfig(level=logging.WARNING)
+	failed = False
+	for name in args.bench or sorted(BENCHES):
+		print("== {}".format(name))
+		try:
+			BENCHES[name]()
+		except BenchFailure as e:
+			logger.error("{} failed: {}".format(name, e))
+			failed = True
+	return 1 if failed else 0
+
+if __name__ == "__main__":
+	sys.exit(main())
@@ -2,14 +2,29 @@ from .led import LEDController
 from .footswitch import FootSwitchEventBus, Layout, FootSwitch, EventType
 from .session import Session
 from functools import partial
+from .trace import tracer
 import logging
 import Live
 
 logger = logging.getLogger(__name__)
 
+TRACE_NEXT_MODE = tracer.event("Next mode")
+TRACE_PREV_MODE = tracer.event("Previous mode")
+TRACE_SAME_MODE = tracer.event("Not changing mode. {} is already set.")
+TRACE_SET_MODE = tracer.event("Set mode {}")
+
 class Mode:
+	"""
+	Modes build their bindings in get_layout(). The board goes through
+	layout() instead, which hands back the same Layout until the mode's
+	layout version moves on. That happens when the mode reports a layout
+	change, so switching between modes that didn't change builds nothing.
+	"""
 	def __init__(self, leds: LEDController):
 		self.leds = leds
+		self._layout = None
+		self._layout_version = 0
+		self._built_version = None
 
 	def activate(self):
 		self.leds.activate()
@@ -23,9 +38,25 @@ class Mode:
 	def get_layout(self):
 		raise NotImplementedError()
 
+	def layout(self) -> Layout:
+		if self._built_version != self._layout_version:
+			self._built_version = self._layout_version
+			self._layout = self.get_layout()
+		return self._layout
+
+	def layout_version(self) -> int:
+		return self._layout_version
+
+	def invalidate_layout(self):
+		self._layout_version += 1
+
 	def set_track(self, track: Live.Track.Track):
 		raise NotImplementedError()
 
+	def clear(self):
+		"""Lets go of the track and everything on it"""
+		pass
+
 class Board:
 	def __init__(self, leds: LEDController, footswitch_events: FootSwitchEventBus):
 		self._leds = leds
@@ -39,6 +70,7 @@ class Board:
 		l = Layout()
 		l.listen(FootSwitch.UP, EventType.PRESS, self._prev_mode)
 		l.listen(FootSwitch.DOWN, EventType.PRESS, self._next_mode)
+		l.listen_combo([FootSwitch.UP, FootSwitch.DOWN], self._redraw)
 		self._footswitch_events.install(l)
 		
 		self._current_track = None
@@ -56,9 +88,12 @@ class Board:
 
 		if self._current_mode is None:
 			self._next_mode()
+		else:
+			# not on the board yet, so it doesn't need its Live listeners
+			mode.deactivate()
 
 	def _next_mode(self, *a):
-		logger.info("Next mode")
+		tracer.trace(TRACE_NEXT_MODE)
 		if len(self._modes) == 0:
 			return
 		if self._current_mode is None:
@@ -70,7 +105,7 @@ class Board:
 		self._set_mode(mode)
 
 	def _prev_mode(self, *a):
-		logger.info("Previous mode")
+		tracer.trace(TRACE_PREV_MODE)
 		if len(self._modes) == 0:
 			return
 		if self._current_mode is None:
@@ -81,13 +116,20 @@ class Board:
 				mode = len(self._modes) - 1
 		self._set_mode(mode)
 
+	def _redraw(self, *a):
+		"""Redraws every LED, e.g. if the board lost power"""
+		self._leds.activate()
+		if self._current_mode is not None:
+			self._modes[self._current_mode].activate()
+
 	def _set_mode(self, ind):
 		if self._current_mode == ind:
-			logger.info("Not changing mode. It's already set.")
+			tracer.trace(TRACE_SAME_MODE, ind)
 			return
+		tracer.trace(TRACE_SET_MODE, ind)
 		if self._current_mode is not None:
 			self._modes[self._current_mode].deactivate()
-			self._footswitch_events.uninstall(self._modes[self._current_mode].get_layout())
+			self._footswitch_events.uninstall(self._current_mode_layout)
 			if self._current_mode < len(self._mode_led_values):
 				self._leds.off(self._mode_led_values[self._current_mode])
 		self._modes[ind].activate()
@@ -110,10 +152,11 @@ class Board:
 			break
 
 	def _refresh_layout(self, ind):
+		self._modes[ind].invalidate_layout()
 		if self._current_mode == ind:
 			self._footswitch_events.uninstall(self._current_mode_layout)
 			self._install_mode_layout(ind)
 
 	def _install_mode_layout(self, ind):
-		self._current_mode_layout = self._modes[ind].get_layout()
+		self._current_mode_layout = self._modes[ind].layout()
 		self._footswitch_events.install(self._current_mode_layout)
@@ -0,0 +1,134 @@
+from time import monotonic
+import threading
+
+class SystemClock:
+	"""
+	Real time. The gesture engine, LED engine and tap tempo get their time,
+	their waitable events and their threads from a clock, so a VirtualClock
+	can be swapped in to run them without waiting in real time.
+	"""
+	def now(self) -> float:
+		return monotonic()
+
+	def event(self):
+		return threading.Event()
+
+	def start_thread(self, target):
+		threading.Thread(target=target, daemon=True).start()
+
+system_clock = SystemClock()
+
+class VirtualClock:
+	"""
+	A clock that only moves when advance() is called.
+
+	Every thread started through the clock is tracked: it's busy from the
+	moment it's started or released from a wait until it waits on a clock
+	event again. advance() steps through the pending wait deadlines in order
+	and lets the released threads settle at each one, and settle() waits for
+	threads released by event.set() (e.g. a MIDI message fed in by a test), so
+	runs are exact and reproducible however long the simulated time span.
+	"""
+	def __init__(self, start: float = 0.0):
+		self._now = start
+		self._condition = threading.Condition()
+		self._waiters = []
+		self._threads = set()
+		self._busy = set()
+
+	def now(self) -> float:
+		return self._now
+
+	def event(self):
+		return VirtualEvent(self)
+
+	def start_thread(self, target):
+		def run():
+			try:
+				target()
+			finally:
+				with self._condition:
+					self._threads.discard(thread)
+					self._busy.discard(thread)
+					self._condition.notify_all()
+		thread = threading.Thread(target=run, daemon=True)
+		with self._condition:
+			self._threads.add(thread)
+			self._busy.add(thread)
+		thread.start()
+
+	def advance(self, seconds: float):
+		with self._condition:
+			target = self._now + seconds
+			while True:
+				self._settle()
+				deadlines = [w.deadline for w in self._waiters if w.deadline is not None and w.deadline <= target]
+				if len(deadlines) == 0:
+					break
+				self._now = max(self._now, min(deadlines))
+				for waiter in self._waiters:
+					if waiter.deadline is not None and waiter.deadline <= self._now:
+						self._release(waiter)
+				self._condition.notify_all()
+			self._now = target
+
+	def settle(self):
+		with self._condition:
+			self._settle()
+
+	def _settle(self):
+		while len(self._busy) > 0:
+			self._condition.wait()
+
+	def _release(self, waiter):
+		if not waiter.released:
+			waiter.released = True
+			if waiter.thread in self._threads:
+				self._busy.add(waiter.thread)
+
+	def _wait(self, event, timeout):
+		with self._condition:
+			thread = threading.current_thread()
+			self._busy.discard(thread)
+			self._condition.notify_all()
+			waiter = Waiter(event, None if timeout is None else self._now + timeout, thread)
+			self._waiters.append(waiter)
+			while not waiter.released and not event._flag:
+				self._condition.wait()
+			self._waiters.remove(waiter)
+			if thread in self._threads:
+				self._busy.add(thread)
+			return event._flag
+
+	def _set(self, event):
+		with self._condition:
+			event._flag = True
+			for waiter in self._waiters:
+				if waiter.event is event:
+					self._release(waiter)
+			self._condition.notify_all()
+
+class Waiter:
+	def __init__(self, event, deadline, thread):
+		self.event = event
+		self.deadline = deadline
+		self.thread = thread
+		self.released = False
+
+class VirtualEvent:
+	"""threading.Event look-alike whose wait timeouts run on a VirtualClock"""
+	def __init__(self, clock: VirtualClock):
+		self._clock = clock
+		self._flag = False
+
+	def is_set(self) -> bool:
+		return self._flag
+
+	def set(self):
+		self._clock._set(self)
+
+	def clear(self):
+		self._flag = False
+
+	def wait(self, timeout = None) -> bool:
+		return self._clock._wait(self, timeout)
@@ -0,0 +1,147 @@
+from ableton.v2.base import liveobj_valid
+from functools import partial
+from .listeners import add_listener, remove_listener
+from .metrics import metrics, PARAMETER_WRITES
+import logging
+
+logger = logging.getLogger(__name__)
+
+class DeviceIndex:
+	"""
+	Maps each device to a {parameter name: parameter} table so modes can
+	find "Device On", "enable", "bars" etc. without walking the device's
+	parameters. A device's table is built the first time it's looked up
+	and dropped when Live reports that its parameter list, or the name of
+	one of its parameters, changed, or when the device leaves its track
+	(NameListeners sees it go). The next lookup rebuilds it.
+
+	Live doesn't tell a device's listeners that it was deleted and reuses
+	the addresses of deleted objects, so a lookup also rebuilds a table
+	whose device is no longer valid rather than hand out its parameters.
+	"""
+	def __init__(self):
+		self._parameters = {}
+		self._listeners = {}
+
+	def parameter(self, device, name: str):
+		"""Returns the device's parameter called name, or None"""
+		return self.parameters(device).get(name)
+
+	def parameters(self, device):
+		ptr = device._live_ptr
+		if ptr in self._parameters and not liveobj_valid(self._listeners[ptr][0]):
+			self._invalidate(ptr)
+		if ptr not in self._parameters:
+			self._build(ptr, device)
+		return self._parameters[ptr]
+
+	def invalidate(self, device):
+		self._invalidate(device._live_ptr)
+
+	def _build(self, ptr, device):
+		parameters = {}
+		name_listeners = []
+		invalidate = partial(self._invalidate, ptr)
+		for p in device.parameters:
+			if p.name not in parameters:
+				parameters[p.name] = p
+			if add_listener(p, "name", invalidate):
+				name_listeners.append(p)
+		add_listener(device, "parameters", invalidate)
+		self._parameters[ptr] = parameters
+		self._listeners[ptr] = (device, invalidate, name_listeners)
+
+	def _invalidate(self, ptr):
+		self._parameters.pop(ptr, None)
+		if ptr not in self._listeners:
+			return
+		device, invalidate, name_listeners = self._listeners.pop(ptr)
+		for p in name_listeners:
+			remove_listener(p, "name", invalidate)
+		remove_listener(device, "parameters", invalidate)
+
+class NameListeners:
+	"""
+	Keeps a name listener registered on each device of a changing list,
+	only touching the devices that were added or removed since last time.
+	Devices that drop out of the list are dropped from the device_index.
+	"""
+	def __init__(self, callback):
+		self._callback = callback
+		self._devices = {}
+
+	def update(self, devices):
+		current = {d._live_ptr: d for d in devices}
+		for ptr in [ptr for ptr in self._devices if ptr not in current]:
+			self._remove(self._devices.pop(ptr))
+		for ptr, device in current.items():
+			if ptr not in self._devices:
+				add_listener(device, "name", self._callback)
+				self._devices[ptr] = device
+
+	def clear(self):
+		for device in self._devices.values():
+			self._remove(device)
+		self._devices = {}
+
+	def _remove(self, device):
+		device_index.invalidate(device)
+		remove_listener(device, "name", self._callback)
+
+class ParameterValues:
+	"""
+	Write-through cache of parameter values, kept fresh by a value listener
+	on every watched parameter. write() only goes to Live when the value
+	actually changes, so selecting a patch costs one write per device that
+	changes state rather than one per device. Watches are counted, so
+	several users can watch the same parameter.
+	"""
+	def __init__(self):
+		self._values = {}
+		self._watches = {}
+
+	def watch(self, param):
+		ptr = param._live_ptr
+		if ptr in self._watches:
+			self._watches[ptr][2] += 1
+			return
+		listener = partial(self._changed, ptr, param)
+		add_listener(param, "value", listener)
+		self._watches[ptr] = [param, listener, 1]
+		self._values[ptr] = param.value
+
+	def unwatch(self, param):
+		ptr = param._live_ptr
+		if ptr not in self._watches:
+			return
+		watch = self._watches[ptr]
+		watch[2] -= 1
+		if watch[2] > 0:
+			return
+		del self._watches[ptr]
+		self._values.pop(ptr, None)
+		remove_listener(param, "value", watch[1])
+
+	def value(self, param):
+		ptr = param._live_ptr
+		if ptr in self._values:
+			return self._values[ptr]
+		return param.value
+
+	def write(self, param, value) -> bool:
+		"""Sets param to value unless it already is. Returns whether it wrote."""
+		if self.value(param) == value:
+			return False
+		metrics.count(PARAMETER_WRITES)
+		param.value = value
+		ptr = param._live_ptr
+		if ptr in self._values:
+			self._values[ptr] = value
+		return True
+
+	def _changed(self, ptr, param):
+		if ptr in self._values:
+			self._values[ptr] = param.value
+
+device_index = DeviceIndex()
+parameter_values = ParameterValues()
@@ -1,8 +1,11 @@
-from .led import LEDController
+from .led import LEDController, PredictedState
 from .footswitch import FootSwitchEventType, FootSwitch, EventType, Layout, numbered_footswitches, bottom_row, top_row
 from .board import Mode
 from functools import partial
-from ableton.v2.base import liveobj_valid
+from .trace import tracer
+from .device_index import device_index, parameter_values, NameListeners
+from .metrics import metrics, PARAMETER_WRITES
+from .listeners import Subscription, add_listener, remove_listener
 import Live
 import sys
 import logging
@@ -10,6 +13,8 @@ import logging
 
 logger = logging.getLogger(__name__)
 
+TRACE_ADD_DEVICE = tracer.event("Adding new device with class {} and name {}")
+
 class EffectsMode(Mode):
 	"""
 	Mode for messing with tone
@@ -26,8 +31,20 @@ class EffectsMode(Mode):
 		self._leds = leds
 		self._stomps = [Stomp(fs, leds) for fs in bottom_row()]
 		self._patch = OneHotRack(top_row(), leds)
+		self._patch_rack = None
+		self._names = NameListeners(self._update_patch)
 		self._track = None
 
+	def activate(self):
+		for s in self._stomps: s.resume()
+		self._patch.resume()
+		super(EffectsMode, self).activate()
+
+	def deactivate(self):
+		super(EffectsMode, self).deactivate()
+		for s in self._stomps: s.suspend()
+		self._patch.suspend()
+
 	def get_layout(self):
 		l = Layout()
 		for s in self._stomps: l.union_with(s.get_layout())
@@ -38,23 +55,42 @@ class EffectsMode(Mode):
 		if track != self._track:
 			self.clear()
 		self._track = track
-		self._track.add_devices_listener(self._update_devices)
+		add_listener(self._track, "devices", self._update_devices)
 		self._update_devices()
 
 	def _update_devices(self):
-		self._clear_devices()
+		"""Only rebinds the stomps whose device changed"""
 		try:
-			for stomp, device in zip(self._stomps, filter(self._non_looper, self._track.devices)):
-				logger.info("Adding new {} device with class {} and name {}".format(device.type, device.class_name, device.name))
-				device.add_name_listener(self._update_devices)
-				stomp.listen_to_device(device)
-			for device in self._track.devices:
-				if "#1hot" in device.name:
-					self._patch.listen_to_rack(device)
-					break
+			devices = list(self._track.devices)
+			self._names.update(devices)
+			stomp_devices = list(filter(self._non_looper, devices))[:len(self._stomps)]
+			stomp_devices += [None] * (len(self._stomps) - len(stomp_devices))
+			for stomp, device in zip(self._stomps, stomp_devices):
+				if stomp.device() == device:
+					continue
+				stomp.clear()
+				if device is not None:
+					tracer.trace(TRACE_ADD_DEVICE, device.class_name, device.name)
+					stomp.listen_to_device(device)
+			self._update_patch()
 		except:
 			logger.info("Failed to update devices, is track gone? {}".format(sys.exc_info()[1]))
 
+	def _update_patch(self):
+		"""Device names only matter for finding the #1hot rack"""
+		rack = None
+		for device in self._track.devices:
+			if "#1hot" in device.name:
+				rack = device
+				break
+		if rack == self._patch_rack:
+			return
+		self._patch_rack = rack
+		if rack is None:
+			self._patch.clear()
+		else:
+			self._patch.listen_to_rack(rack)
+
 	def _non_looper(self, device):
 		return device.class_name != "Looper"
 
@@ -64,8 +100,7 @@ class EffectsMode(Mode):
 		if track is not None and track != self._track:
 			return
 		try:
-			if self._track.devices_has_listener(self._update_devices):
-				self._track.remove_devices_listener(self._update_devices)
+			remove_listener(self._track, "devices", self._update_devices)
 		except:
 			logger.warning("Failed to remove devices listener. Track must be deleted")
 		
@@ -75,39 +110,51 @@ class EffectsMode(Mode):
 	def _clear_devices(self):
 		if self._track is None:
 			return
-		for device in self._track.devices:
-			if device.name_has_listener(self._update_devices):
-				device.remove_name_listener(self._update_devices)
+		self._names.clear()
 		for stomp in self._stomps: stomp.clear()
 		self._patch.clear()
+		self._patch_rack = None
 
 
 class Stomp:
 	def __init__(self, footswitch: FootSwitch, leds: LEDController):
 		self._led = DeviceEnabledLED(footswitch, leds)
 		self._footswitch = footswitch
+		self._device = None
 		self._on_param = None
 
+	def device(self):
+		return self._device
+
 	def get_layout(self):
 		l = Layout()
 		l.listen(self._footswitch, EventType.PRESS, self._toggle)
 		return l
 
 	def listen_to_device(self, device: Live.Device.Device):
+		self._device = device
 		self._led.listen_to_device(device)
-		for p in device.parameters:
-			if p.name == "Device On":
-				self._on_param = p
+		self._on_param = device_index.parameter(device, "Device On")
 
 	def clear(self):
 		self._led.clear()
+		self._device = None
 		self._on_param = None
+
+	def suspend(self):
+		self._led.suspend()
+
+	def resume(self):
+		self._led.resume()
 		
 	def _toggle(self, *a):
 		if self._on_param is not None:
+			metrics.count(PARAMETER_WRITES)
 			if self._on_param.value == 1.0:
+				self._led.predict(False)
 				self._on_param.value = 0.0
 			else:
+				self._led.predict(True)
 				self._on_param.value = 1.0
 
 class OneHotRack:
@@ -115,6 +162,7 @@ class OneHotRack:
 	def __init__(self, footswitches, leds: LEDController):
 		self._footswitches = footswitches
 		self._leds = [DeviceEnabledLED(fs, leds) for fs in footswitches]
+		self._leds_by_footswitch = dict(zip(footswitches, self._leds))
 		self._ons = {}
 
 	def get_layout(self):
@@ -142,47 +190,72 @@ class OneHotRack:
 
 		for footswitch, led, device in zip(self._footswitches, self._leds, devices):
 			led.listen_to_device(device)
-			for p in device.parameters:
-				if p.name == "Device On":
-					self._ons[footswitch] = p
+			on = device_index.parameter(device, "Device On")
+			if on is not None:
+				parameter_values.watch(on)
+				self._ons[footswitch] = on
 
 
 	def clear(self):
+		for on in self._ons.values():
+			parameter_values.unwatch(on)
 		self._ons = {}
 		for led in self._leds:
 			led.clear()
 
+	def suspend(self):
+		for led in self._leds:
+			led.suspend()
+
+	def resume(self):
+		for led in self._leds:
+			led.resume()
+
 	def pressed(self, footswitch, *a):
 		if footswitch not in self._ons:
 			return
 		for fs, on in self._ons.items():
-			if fs == footswitch:
-				on.value = 1.0
-			else:
-				on.value = 0.0
+			if parameter_values.write(on, 1.0 if fs == footswitch else 0.0):
+				self._leds_by_footswitch[fs].predict(fs == footswitch)
 
 class DeviceEnabledLED:
+	"""Lights while the device is active. predict() lights it ahead of Live."""
 	def __init__(self, footswitch: FootSwitch, leds: LEDController):
 		self._on = partial(leds.on, footswitch.led_value())
 		self._off = partial(leds.off, footswitch.led_value())
-		self._device = None
+		self._active = Subscription("is_active", self._update_state)
+		self._state = PredictedState(self._is_active, self._draw, leds.prediction_expiry())
 
 	def listen_to_device(self, device):
-		if self._device != device:
-			self.clear()
-		self._device = device
-		self._device.add_is_active_listener(self._update_state)
+		if device != self._active.subject():
+			self._state.reset()
+		self._active.set_subject(device)
 		self._update_state()
 
 	def clear(self):
-		if self._device is not None:
-			if liveobj_valid(self._device):
-				self._device.remove_is_active_listener(self._update_state)
-			self._device = None
+		self._active.set_subject(None)
+		self._state.reset()
 		self._update_state()
 
+	def predict(self, active: bool):
+		if self._active.subject() is not None:
+			self._state.predict(active)
+
+	def suspend(self):
+		self._active.suspend()
+
+	def resume(self):
+		self._active.resume()
+
 	def _update_state(self):
-		if self._device is not None and self._device.is_active:
+		self._state.update()
+
+	def _is_active(self) -> bool:
+		device = self._active.subject()
+		return device is not None and bool(device.is_active)
+
+	def _draw(self, active: bool):
+		if active:
 			self._on()
 		else:
 			self._off()
@@ -0,0 +1,83 @@
+from ableton.v2.base import liveobj_valid
+from .metrics import metrics, PARAMETER_WRITES
+from .undo import undo_grouper
+import logging
+
+try:
+	import numpy
+except ImportError:
+	numpy = None
+
+logger = logging.getLogger(__name__)
+
+# Expression pedals send 7 bit CCs
+CC_VALUES = 128
+
+# Below this many targets the plain python table build is faster than numpy's
+NUMPY_MIN_TARGETS = 8
+
+class ExpressionGroup:
+	"""
+	A set of parameters driven by one expression pedal. Each target maps the
+	pedal's 0-127 onto its own range, through a curve: the pedal position in
+	[0, 1] is raised to the target's exponent before scaling, so a curve > 1
+	is slow at the heel and a curve < 1 is slow at the toe. lo > hi sweeps the
+	target the other way.
+
+	Since a pedal only ever sends 128 values, the whole group is evaluated up
+	front into a 128 row table (with numpy when it's installed and the group
+	is big enough), rebuilt when targets are added. Each incoming CC is one
+	row lookup and one pass writing the targets whose value actually changed,
+	inside the undo step of the current pedal burst.
+	"""
+	def __init__(self):
+		self._params = []
+		self._ranges = []
+		self._table = None
+		self._written = []
+
+	def add_target(self, param, lo = None, hi = None, curve: float = 1.0):
+		"""lo and hi default to the parameter's range and are clamped to it"""
+		clamp = lambda v: min(param.max, max(param.min, v))
+		self._params.append(param)
+		self._ranges.append((
+			clamp(lo) if lo is not None else param.min,
+			clamp(hi) if hi is not None else param.max,
+			curve))
+		self._written.append(None)
+		self._table = None
+
+	def reset(self):
+		"""Forget what was written, so the next CC writes every target"""
+		self._written = [None] * len(self._params)
+
+	def __len__(self):
+		return len(self._params)
+
+	def __call__(self, value):
+		if self._table is None:
+			self._table = self._build_table()
+		row = self._table[min(CC_VALUES - 1, max(0, value))]
+		written = 0
+		for ind, param in enumerate(self._params):
+			if row[ind] == self._written[ind]:
+				continue
+			if not liveobj_valid(param):
+				continue
+			if written == 0:
+				undo_grouper.burst()
+			param.value = row[ind]
+			self._written[ind] = row[ind]
+			written += 1
+		metrics.count(PARAMETER_WRITES, written)
+
+	def _build_table(self):
+		if numpy is not None and len(self._ranges) >= NUMPY_MIN_TARGETS:
+			lo, hi, curve = (numpy.array(column, dtype=float) for column in zip(*self._ranges))
+			position = numpy.linspace(0.0, 1.0, CC_VALUES)[:, None]
+			return (lo + (hi - lo) * position ** curve).tolist()
+		table = []
+		for value in range(CC_VALUES):
+			position = value / (CC_VALUES - 1)
+			table.append([lo + (hi - lo) * position ** curve for lo, hi, curve in self._ranges])
+		return table
@@ -6,8 +6,17 @@ from .loop_mode import LoopMode
 from .session_mode import SessionMode
 from .racks_controller import RacksControllerMode
 from .board import Board
+from .setlist import Setlist, SetlistMode
+from .gestures import GestureProfile
+from .undo import undo_grouper
+from .metrics import MetricsExporter
+from .watchdog import Watchdog
+from .snapshot import export_snapshot
+from .quantize import ActionScheduler, Quantization
+from .async_runtime import AsyncRuntime, AsyncFootSwitchEventBus, AsyncLEDController
 import logging
 import Live
+import os
 import sys
 import inspect
 
@@ -20,6 +29,32 @@ FOOTSWITCH_UP_ID = 105
 
 CC_MSG = 0xB0
 
+# Local UDP port the metrics collector listens on
+METRICS_PORT = 9901
+
+# Number of looping channel tracks SessionMode keeps to the right of the #fcb track
+SESSION_CHANNELS = 4
+
+# Grid RacksControllerMode patch changes wait for (None, Quantization.BEAT or Quantization.BAR)
+PATCH_QUANTIZATION = None
+
+# Run the event bus, gesture timers and LEDs on a single asyncio loop instead of a thread each
+ASYNC_RUNTIME = False
+
+# One #fcb track per song: prebuild every song's modes and add a mode for picking the song
+SETLIST = False
+
+# Write a snapshot of the set's topology here when the script shuts down (see snapshot.py)
+SNAPSHOT_PATH = None
+
+# Seconds between checks for leaked threads, listeners and memory (None to not watch)
+WATCHDOG_INTERVAL = 60.0
+WATCHDOG_TRACE_MEMORY = False
+
+# Tighten each switch's long/double press timing to how it's actually played
+GESTURE_ADAPTIVE = False
+GESTURE_PROFILE_PATH = os.path.join(os.path.expanduser("~"), ".fcb1010_gestures.json")
+
 class FcbSurface(ControlSurface):
 
 	def __init__(self, c_instance, *a, **k):
@@ -34,18 +69,72 @@ class FcbSurface(ControlSurface):
 		self.__c_instance = c_instance
 
 		with self.component_guard():
-			leds = LEDController(self.send_cc)
-			event_bus = FootSwitchEventBus()
+			self._gesture_profile = GestureProfile(GESTURE_ADAPTIVE)
+			self._gesture_profile.load(GESTURE_PROFILE_PATH)
+			self._runtime = None
+			scheduler = self.schedule_message
+			if ASYNC_RUNTIME:
+				self._runtime = AsyncRuntime()
+				scheduler = self._runtime.schedule_message
+				leds = AsyncLEDController(self.send_cc, self._runtime)
+				event_bus = AsyncFootSwitchEventBus(self._runtime, profile=self._gesture_profile)
+			else:
+				leds = LEDController(self.send_cc)
+				event_bus = FootSwitchEventBus(profile=self._gesture_profile)
 			
 			self._board = Board(leds, event_bus)
-			self._board.add_mode(RacksControllerMode(leds.copy([f.led_value() for f in numbered_footswitches()]), self.schedule_message))
-			# self._board.add_mode(EffectsMode(leds.copy([f.led_value() for f in numbered_footswitches()])))
-			# self._board.add_mode(LoopMode(leds.copy([f.led_value() for f in numbered_footswitches()])))
-			self._board.add_mode(SessionMode(leds.copy([f.led_value() for f in numbered_footswitches()]), self.schedule_message))
+			action_scheduler = ActionScheduler() if PATCH_QUANTIZATION is not None else None
+			def racks_mode():
+				return RacksControllerMode(
+					leds.copy([f.led_value() for f in numbered_footswitches()]),
+					scheduler,
+					action_scheduler,
+					PATCH_QUANTIZATION)
+			def session_mode():
+				return SessionMode(leds.copy([f.led_value() for f in numbered_footswitches()]), scheduler, SESSION_CHANNELS)
+			if SETLIST:
+				# session modes create and arm channel tracks, so only the selected song gets one
+				setlist = Setlist(scheduler, [racks_mode], [session_mode])
+				self._board.add_mode(SetlistMode(leds.copy([f.led_value() for f in numbered_footswitches()]), setlist))
+				for mode in setlist.modes():
+					self._board.add_mode(mode)
+			else:
+				self._board.add_mode(racks_mode())
+				# self._board.add_mode(EffectsMode(leds.copy([f.led_value() for f in numbered_footswitches()])))
+				# self._board.add_mode(LoopMode(leds.copy([f.led_value() for f in numbered_footswitches()])))
+				self._board.add_mode(session_mode())
 
 			self.add_received_midi_listener(event_bus.midi_callback)
 			logger.info("Added midi received listener")
 
+			self._metrics_exporter = MetricsExporter(METRICS_PORT)
+			self._metrics_exporter.start()
+
+			self._watchdog = None
+			if WATCHDOG_INTERVAL is not None:
+				self._watchdog = Watchdog(WATCHDOG_INTERVAL, trace_memory=WATCHDOG_TRACE_MEMORY)
+				self._watchdog.start()
+
+	def disconnect(self):
+		if SNAPSHOT_PATH is not None:
+			try:
+				export_snapshot(Live.Application.get_application().get_document(), SNAPSHOT_PATH)
+			except Exception:
+				logger.error("Couldn't write snapshot: {}".format(sys.exc_info()[1]))
+		self._metrics_exporter.stop()
+		if self._watchdog is not None:
+			self._watchdog.stop()
+		self._gesture_profile.save(GESTURE_PROFILE_PATH)
+		undo_grouper.end_burst()
+		if self._runtime is not None:
+			self._runtime.stop()
+		super(FcbSurface, self).disconnect()
+
+	def update_display(self):
+		super(FcbSurface, self).update_display()
+		if self._runtime is not None:
+			self._runtime.drain()
+
 
 	def build_midi_map(self, midi_map_handle):
 		Live.MidiMap.forward_midi_cc(self.__c_instance.handle(), midi_map_handle, 0, FOOTSWITCH_DOWN_ID) # button down
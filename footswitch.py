@@ -6,6 +6,12 @@ import time
 import threading
 import queue
 import traceback
+from collections import deque
+from .trace import tracer
+from .clock import system_clock
+from .gestures import GestureProfile, LONG_PRESS_DURATION, DOUBLE_PRESS_DURATION
+from .metrics import metrics, switch_event_index, EXPRESSION_CC, DEBOUNCE_REJECTED, \
+	INPUT_OVERFLOW, CC_COALESCED, QUEUE_DEPTH
 
 CC_BYTE = 176
 DOWN_BYTE = 104
@@ -13,8 +19,21 @@ UP_BYTE = 105
 LEFT_EXPR_BYTE = 102
 RIGHT_EXPR_BYTE = 103
 
+# Seconds after an accepted edge during which the switch's next edge is taken as bounce
+DEBOUNCE_WINDOW = 0.03
+
+# Seconds within which the switches of a combo must all go down
+COMBO_WINDOW = 0.08
+SEQUENCE_WINDOW = 0.6
+
+# Switch edges queued beyond this count as an overflow (they're still kept)
+INPUT_QUEUE_CAPACITY = 64
+
 logger = logging.getLogger(__name__)
 
+# Holds the MIDI arrival time of the event being notified on each notifier thread
+_event_context = threading.local()
+
 # Foot switch identifier
 class FootSwitch(Enum):
 	ONE 	= 1
@@ -76,6 +95,7 @@ class Layout:
 	"""
 	def __init__(self):
 		self._callbacks = {}
+		self._combos = []
 		self._left_expression_callback = None
 		self._right_expression_callback = None
 
@@ -84,6 +104,14 @@ class Layout:
 			self._callbacks[footswitch] = {}
 		self._callbacks[footswitch][event_type] = cb
 
+	def listen_combo(self, footswitches, cb, sequential = False, window = None):
+		"""
+		Calls cb when all footswitches go down together, or one after the
+		other in the given order if sequential. The switches' own events are
+		swallowed when the combo fires.
+		"""
+		self._combos.append(Combo(footswitches, cb, sequential, window))
+
 	def set_left_expression_callback(self, cb):
 		self._left_expression_callback = cb
 
@@ -99,23 +127,61 @@ class Layout:
 	def get_callbacks(self):
 		return self._callbacks
 
+	def get_combos(self):
+		return self._combos
+
 	def union_with(self, other):
 		self._callbacks.update(other._callbacks)
+		self._combos.extend(other._combos)
+
+class Combo:
+	"""Several footswitches pressed together, or one after the other if sequential"""
+	def __init__(self, footswitches, cb, sequential = False, window = None):
+		self.footswitches = tuple(footswitches)
+		self.values = [switch_to_value(fs) for fs in footswitches]
+		self.sequential = sequential
+		if window is None:
+			window = SEQUENCE_WINDOW if sequential else COMBO_WINDOW
+		self.window = window
+		self.callbacks = {EventType.PRESS: cb}
+
+	def key(self):
+		return (self.footswitches, self.sequential)
 
 class FootSwitchEventBus:
 	"""
-	Handles all the events of the 10 numbered foot switches + UP + DOWN.
-	Does not handle expression pedal events.
+	Handles all the events of the 10 numbered foot switches + UP + DOWN,
+	and hands expression pedal CCs to the installed callbacks.
+
+	midi_callback only timestamps and queues; everything else happens on the
+	InputQueue's thread, switch edges first.
 	"""
-	def __init__(self):
-		self._notifiers = {switch: Notifier() for switch in FootSwitch}
+	def __init__(self, debounce_window = DEBOUNCE_WINDOW, clock = system_clock, profile: GestureProfile = None):
+		self._clock = clock
+		self._profile = profile if profile is not None else GestureProfile()
+		self._notifiers = {switch: Notifier(switch, clock, self._profile) for switch in FootSwitch}
+		self._debouncer = Debouncer(debounce_window)
+		self._combos = ComboDetector(self._forward, clock)
 		self._left_expression = self._noop
 		self._right_expression = self._noop
+		self._input = InputQueue(self._edge, self._expression, clock)
+
+	def set_debounce(self, footswitch: FootSwitch, window: float):
+		"""Set the chatter window (in seconds) for a single foot switch"""
+		self._debouncer.set_window(footswitch, window)
+
+	def debouncer(self):
+		return self._debouncer
+
+	def profile(self) -> GestureProfile:
+		return self._profile
 
 	def install(self, layout: Layout):
 		for footswitch, cb_map in layout.get_callbacks().items():
 			for event_type, cb in cb_map.items():
 				self._notifiers[footswitch].set_callback(event_type, cb)
+		for combo in layout.get_combos():
+			self._combos.add(combo)
 		if layout.left_expression_callback() is not None:
 			self._left_expression = layout.left_expression_callback()
 		if layout.right_expression_callback() is not None:
@@ -125,35 +191,308 @@ class FootSwitchEventBus:
 		for footswitch, cb_map in layout.get_callbacks().items():
 			for event_type in cb_map.keys():
 				self._notifiers[footswitch].clear_callback(event_type)
+		for combo in layout.get_combos():
+			self._combos.remove(combo)
 		if layout.left_expression_callback() is not None:
 			self._left_expression = self._noop
 		if layout.right_expression_callback() is not None:
 			self._right_expression = self._noop
 
+	def input_queue(self):
+		return self._input
+
 	def midi_callback(self, byte1, byte2, byte3, *a):
 		if byte1 == CC_BYTE:
 			if byte2 == DOWN_BYTE:
-				self._notifiers[value_to_switch(byte3)].down_callback()
+				self._input.put_edge(byte3, True, self._clock.now())
 			elif byte2 == UP_BYTE:
-				self._notifiers[value_to_switch(byte3)].up_callback()
+				self._input.put_edge(byte3, False, self._clock.now())
 			elif byte2 == LEFT_EXPR_BYTE:
-				self._left_expression(byte3)
+				metrics.count(EXPRESSION_CC)
+				self._input.put_cc(InputQueue.LEFT, byte3)
 			elif byte2 == RIGHT_EXPR_BYTE:
-				self._right_expression(byte3)
+				metrics.count(EXPRESSION_CC)
+				self._input.put_cc(InputQueue.RIGHT, byte3)
+
+	def _edge(self, value, down, arrival):
+		if not self._debouncer.accept(value, down, arrival):
+			return
+		if self._combos.intercepts(value):
+			self._combos.edge(value, down, arrival)
+		else:
+			self._forward(value, down, arrival)
+
+	def _expression(self, pedal, value):
+		if pedal == InputQueue.LEFT:
+			self._left_expression(value)
+		else:
+			self._right_expression(value)
+
+	def _forward(self, value, down, arrival):
+		if down:
+			self._notifiers[value_to_switch(value)].down_callback(arrival)
+		else:
+			self._notifiers[value_to_switch(value)].up_callback(arrival)
 
 	def _noop(self, val):
 		pass
 
+class InputQueue:
+	"""
+	Decouples reading MIDI from handling it, with two priority classes.
+
+	Switch edges are never dropped: they're handled in arrival order, and
+	all queued edges are handled before any CC. An edge queued while
+	capacity edges are already waiting is counted as an overflow, but kept.
+
+	Expression CCs only keep the latest value per pedal. A value replaced
+	before it was handled is counted as coalesced. So sweeping both pedals
+	adds at most two CC callbacks ahead of the next switch edge.
+	"""
+	LEFT = 0
+	RIGHT = 1
+
+	def __init__(self, handle_edge, handle_cc, clock = system_clock, capacity: int = INPUT_QUEUE_CAPACITY):
+		self._handle_edge = handle_edge
+		self._handle_cc = handle_cc
+		self._capacity = capacity
+		self._edges = deque()
+		self._ccs = [None, None]
+		self._next_pedal = self.LEFT
+		self._lock = threading.Lock()
+		self._wake = clock.event()
+		metrics.set_sampler(QUEUE_DEPTH, self.depth)
+		clock.start_thread(self.run)
+
+	def put_edge(self, value: int, down: bool, arrival: float):
+		with self._lock:
+			if len(self._edges) >= self._capacity:
+				metrics.count(INPUT_OVERFLOW)
+			self._edges.append((value, down, arrival))
+		self._wake.set()
+
+	def put_cc(self, pedal: int, value: int):
+		with self._lock:
+			if self._ccs[pedal] is not None:
+				metrics.count(CC_COALESCED)
+			self._ccs[pedal] = value
+		self._wake.set()
+
+	def depth(self) -> int:
+		return len(self._edges) + sum(1 for cc in self._ccs if cc is not None)
+
+	def run(self):
+		while True:
+			self._wake.wait()
+			self._wake.clear()
+			while self._handle_next():
+				pass
+
+	def _handle_next(self) -> bool:
+		with self._lock:
+			edge = self._edges.popleft() if len(self._edges) > 0 else None
+			cc = None
+			if edge is None:
+				# alternate between the pedals so one being swept can't starve the other
+				for pedal in (self._next_pedal, 1 - self._next_pedal):
+					if self._ccs[pedal] is not None:
+						cc = (pedal, self._ccs[pedal])
+						self._ccs[pedal] = None
+						self._next_pedal = 1 - pedal
+						break
+		try:
+			if edge is not None:
+				self._handle_edge(*edge)
+			elif cc is not None:
+				self._handle_cc(*cc)
+			else:
+				return False
+		except Exception:
+			logger.error("Caught exception handling input: {}".format(traceback.format_exc()))
+		return True
+
+class ComboDetector:
+	"""
+	Recognises combos. Only switches that are part of an installed combo go
+	through here; every other switch goes straight to its notifier, so combos
+	cost nothing for them.
+
+	Edges of combo switches are held back until either a combo completes, in
+	which case the combo fires and its switches' edges are swallowed up to
+	their UP, or no combo can complete any more / the window of the combos
+	that still could runs out, in which case the held edges are forwarded
+	with their original arrival times.
+	"""
+	def __init__(self, forward, clock = system_clock):
+		self._forward = forward
+		self._clock = clock
+		self._combos = {}
+		self._is_member = [False] * len(_VALUE_TO_SWITCH)
+		self._pending = []
+		self._swallowed = set()
+		self._fired = []
+		self._lock = threading.Lock()
+		self._wake = clock.event()
+		self._start()
+
+	def _start(self):
+		self._clock.start_thread(self.run)
+
+	def add(self, combo: Combo):
+		with self._lock:
+			self._combos[combo.key()] = combo
+			self._update_members()
+
+	def remove(self, combo: Combo):
+		with self._lock:
+			self._combos.pop(combo.key(), None)
+			self._update_members()
+		self._wake.set()
+
+	def intercepts(self, value: int) -> bool:
+		return self._is_member[value]
+
+	def edge(self, value: int, down: bool, arrival: float):
+		with self._lock:
+			if value in self._swallowed:
+				if not down:
+					self._swallowed.discard(value)
+				return
+			self._pending.append((value, down, arrival))
+			if down:
+				self._match(arrival)
+		self._wake.set()
+
+	def run(self):
+		while True:
+			deadline = self.step()
+			self._wake.wait(None if deadline is None else max(0, deadline - self._clock.now()))
+			self._wake.clear()
+
+	def step(self):
+		"""
+		Fires the combos that completed and forwards the held edges that can't
+		be part of one any more. Returns when to step again, or None.
+		"""
+		with self._lock:
+			fired, self._fired = self._fired, []
+			flush = []
+			deadline = None
+			if len(self._pending) > 0:
+				window = self._hold_window()
+				if window is None or self._clock.now() >= self._pending[0][2] + window:
+					flush, self._pending = self._pending, []
+				else:
+					deadline = self._pending[0][2] + window
+		for combo, arrival in fired:
+			dispatch(combo.callbacks, EventType.PRESS, arrival)
+		for value, down, arrival in flush:
+			self._forward(value, down, arrival)
+		return deadline
+
+	def _update_members(self):
+		for value in range(len(self._is_member)):
+			self._is_member[value] = False
+		for combo in self._combos.values():
+			for value in combo.values:
+				self._is_member[value] = True
+
+	def _downs_and_held(self):
+		downs = []
+		held = set()
+		for value, down, _ in self._pending:
+			if down:
+				downs.append(value)
+				held.add(value)
+			else:
+				held.discard(value)
+		return downs, held
+
+	def _match(self, now):
+		downs, held = self._downs_and_held()
+		for combo in self._combos.values():
+			if combo.sequential:
+				matched = downs[-len(combo.values):] == combo.values
+			else:
+				matched = held.issuperset(combo.values)
+			if matched:
+				self._swallowed.update(held.intersection(combo.values))
+				self._pending = [edge for edge in self._pending if edge[0] not in combo.values]
+				self._fired.append((combo, now))
+				return
+
+	def _hold_window(self):
+		"""The longest window of the combos the pending edges could still complete, or None"""
+		downs, held = self._downs_and_held()
+		window = None
+		for combo in self._combos.values():
+			if combo.sequential:
+				could_complete = len(downs) > 0 and downs == combo.values[:len(downs)]
+			else:
+				could_complete = len(held) > 0 and held.issubset(combo.values)
+			if could_complete:
+				window = combo.window if window is None else max(window, combo.window)
+		return window
+
+class Debouncer:
+	"""
+	Filters switch chatter before it reaches the notifiers. An edge is rejected
+	if it repeats the switch's current state, or if it arrives within the
+	switch's window of its last accepted edge (a worn switch bouncing as it's
+	pressed or released).
+
+	State lives in flat lists indexed by the raw MIDI switch value, so filtering
+	a message doesn't allocate.
+	"""
+	def __init__(self, window = DEBOUNCE_WINDOW):
+		size = len(_VALUE_TO_SWITCH)
+		self._windows = [window] * size
+		self._is_down = [False] * size
+		self._last_edge = [float("-inf")] * size
+		self._rejected = [0] * size
+
+	def set_window(self, footswitch: FootSwitch, window: float):
+		self._windows[switch_to_value(footswitch)] = window
+
+	def accept(self, value: int, down: bool, now: float) -> bool:
+		if down == self._is_down[value]:
+			self._reject(value)
+			return False
+		if now - self._last_edge[value] < self._windows[value]:
+			self._reject(value)
+			return False
+		self._is_down[value] = down
+		self._last_edge[value] = now
+		return True
+
+	def _reject(self, value):
+		self._rejected[value] += 1
+		metrics.count(DEBOUNCE_REJECTED)
+
+	def rejected(self, footswitch: FootSwitch) -> int:
+		return self._rejected[switch_to_value(footswitch)]
+
+	def total_rejected(self) -> int:
+		return sum(self._rejected)
+
 class Notifier:
-	LONG_PRESS_DURATION = 0.8
-	DOUBLE_PRESS_DURATION = 0.5
+	LONG_PRESS_DURATION = LONG_PRESS_DURATION
+	DOUBLE_PRESS_DURATION = DOUBLE_PRESS_DURATION
 
-	def __init__(self):
+	def __init__(self, switch: FootSwitch, clock = system_clock, profile: GestureProfile = None):
 		self._callbacks = {}
-		self._down_event = threading.Event()
-		self._up_event = threading.Event()
-		self._killed = threading.Event()
-		threading.Thread(target=self.run, daemon=True).start()
+		self._clock = clock
+		self._value = switch_to_value(switch)
+		self._profile = profile if profile is not None else GestureProfile()
+		self._metric_base = switch_event_index(switch.value, 1) - 1
+		self._down_event = clock.event()
+		self._up_event = clock.event()
+		self._down_time = 0.0
+		self._up_time = 0.0
+		# release of the last press whose double press window closed
+		self._missed_gap = None
+		self._killed = clock.event()
+		clock.start_thread(self.run)
 
 	def __del__(self):
 		self._killed.set()
@@ -168,28 +507,40 @@ class Notifier:
 		logger.info("Running event loop")
 		while not self._killed.is_set():
 			self._await_down()
-			up = self._await_up(self.LONG_PRESS_DURATION)
+			# the profile also sees presses and gaps the learned thresholds misread
+			if self._missed_gap is not None:
+				self._profile.record_gap(self._value, self._down_time - self._missed_gap)
+				self._missed_gap = None
+			up = self._await_up(self._profile.long_press_duration(self._value))
 			if not up:
 				self._notify(EventType.LONG_PRESS)
 				self._await_up()
+				self._profile.record_press(self._value, self._up_time - self._down_time)
 				continue
 
+			self._profile.record_press(self._value, self._up_time - self._down_time)
 			press_event = EventType.PRESS
 
 			if EventType.DOUBLE_PRESS in self._callbacks:
-				if self._await_down(self.DOUBLE_PRESS_DURATION):
+				released = self._up_time
+				if self._await_down(self._profile.double_press_duration(self._value)):
+					self._profile.record_gap(self._value, self._down_time - released)
 					press_event = EventType.DOUBLE_PRESS
 					self._await_up()
+				else:
+					self._missed_gap = released
 
 			self._notify(press_event)
 
 		logger.info("Event loop killed")
 
 
-	def down_callback(self) -> None:
+	def down_callback(self, arrival: float = None) -> None:
+		self._down_time = self._clock.now() if arrival is None else arrival
 		self._down_event.set()
 
-	def up_callback(self) -> None:
+	def up_callback(self, arrival: float = None) -> None:
+		self._up_time = self._clock.now() if arrival is None else arrival
 		self._up_event.set()
 			
 	def _await_down(self, timeout=None):
@@ -207,11 +558,31 @@ class Notifier:
 		return up
 
 	def _notify(self, event_type):
-		if event_type in self._callbacks:
-			try:
-				self._callbacks[event_type](event_type)
-			except Exception:
-				logger.error('Caught exception while notifying {}: {}'.format(event_type, traceback.format_exc()))
+		metrics.count(self._metric_base + event_type.value)
+		# Gestures are stamped with the DOWN that started them
+		dispatch(self._callbacks, event_type, self._up_time if event_type is EventType.UP else self._down_time)
+
+def dispatch(callbacks, event_type: EventType, arrival: float):
+	"""Calls the callback for event_type, if any, with event_time() reporting arrival"""
+	if event_type not in callbacks:
+		return
+	_event_context.arrival = arrival
+	try:
+		callbacks[event_type](event_type)
+	except Exception:
+		logger.error('Caught exception while notifying {}: {}'.format(event_type, traceback.format_exc()))
+		tracer.dump()
+	finally:
+		_event_context.arrival = None
+
+def event_time(clock = system_clock) -> float:
+	"""
+	MIDI arrival time (on the bus's clock) of the footswitch event currently
+	being handled on this thread, or clock's current time outside of a
+	footswitch callback.
+	"""
+	arrival = getattr(_event_context, "arrival", None)
+	return arrival if arrival is not None else clock.now()
 
 def bottom_row():
 	return [
@@ -234,18 +605,25 @@ def top_row():
 def numbered_footswitches():
 	return bottom_row() + top_row()
 
+_VALUE_TO_SWITCH = {
+	1: FootSwitch.ONE,
+	2: FootSwitch.TWO,
+	3: FootSwitch.THREE,
+	4: FootSwitch.FOUR,
+	5: FootSwitch.FIVE,
+	6: FootSwitch.SIX,
+	7: FootSwitch.SEVEN,
+	8: FootSwitch.EIGHT,
+	9: FootSwitch.NINE,
+	0: FootSwitch.TEN,
+	10: FootSwitch.UP,
+	11: FootSwitch.DOWN,
+}
+
+_SWITCH_TO_VALUE = {switch: value for value, switch in _VALUE_TO_SWITCH.items()}
+
 def value_to_switch(value: int) -> FootSwitch:
-	return {
-		1: FootSwitch.ONE,
-		2: FootSwitch.TWO,
-		3: FootSwitch.THREE,
-		4: FootSwitch.FOUR,
-		5: FootSwitch.FIVE,
-		6: FootSwitch.SIX,
-		7: FootSwitch.SEVEN,
-		8: FootSwitch.EIGHT,
-		9: FootSwitch.NINE,
-		0: FootSwitch.TEN,
-		10: FootSwitch.UP,
-		11: FootSwitch.DOWN,
-	}[value]
\ No newline at end of file
+	return _VALUE_TO_SWITCH[value]
+
+def switch_to_value(footswitch: FootSwitch) -> int:
+	return _SWITCH_TO_VALUE[footswitch]
\ No newline at end of file
@@ -0,0 +1,113 @@
+from array import array
+import json
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Default gesture timing, in seconds
+LONG_PRESS_DURATION = 0.8
+DOUBLE_PRESS_DURATION = 0.5
+
+# Learned thresholds never go below these
+MIN_LONG_PRESS_DURATION = 0.4
+MIN_DOUBLE_PRESS_DURATION = 0.2
+
+# Histogram layout: NUM_BINS bins of BIN_WIDTH seconds, the last bin catching everything longer
+BIN_WIDTH = 0.01
+NUM_BINS = 150
+
+# A threshold is only learned once a switch has this many samples
+MIN_SAMPLES = 20
+PERCENTILE = 0.99
+MARGIN = 0.05
+
+NUM_SWITCHES = 12
+
+class GestureProfile:
+	"""
+	Per-switch histograms of how long presses last (DOWN to UP) and of the
+	gap between a press and the next DOWN, each up to its default threshold.
+	Presses are recorded even when the learned threshold already read them
+	as a long press, and gaps even when the learned window had closed, so
+	what the histograms see doesn't depend on the thresholds learned from
+	them and a tightened threshold can relax again.
+
+	When adaptive, the long press threshold and the double press window of
+	a switch are tightened to the PERCENTILE of what's been observed for it,
+	plus MARGIN, once there's enough samples. They never go above the
+	defaults or below the minimums above.
+	"""
+	def __init__(self, adaptive: bool = False):
+		self._adaptive = adaptive
+		self._presses = [array("I", [0]) * NUM_BINS for _ in range(NUM_SWITCHES)]
+		self._gaps = [array("I", [0]) * NUM_BINS for _ in range(NUM_SWITCHES)]
+		self._long_press = [LONG_PRESS_DURATION] * NUM_SWITCHES
+		self._double_press = [DOUBLE_PRESS_DURATION] * NUM_SWITCHES
+
+	def long_press_duration(self, value: int) -> float:
+		return self._long_press[value]
+
+	def double_press_duration(self, value: int) -> float:
+		return self._double_press[value]
+
+	def record_press(self, value: int, duration: float):
+		"""Records a DOWN to UP duration. Holds of LONG_PRESS_DURATION or more are left out."""
+		if duration >= LONG_PRESS_DURATION:
+			return
+		self._presses[value][_bin(duration)] += 1
+		if self._adaptive:
+			self._long_press[value] = _threshold(self._presses[value], MIN_LONG_PRESS_DURATION, LONG_PRESS_DURATION)
+
+	def record_gap(self, value: int, gap: float):
+		"""Records a press's UP to the next DOWN. Gaps of DOUBLE_PRESS_DURATION or more are left out."""
+		if gap >= DOUBLE_PRESS_DURATION:
+			return
+		self._gaps[value][_bin(gap)] += 1
+		if self._adaptive:
+			self._double_press[value] = _threshold(self._gaps[value], MIN_DOUBLE_PRESS_DURATION, DOUBLE_PRESS_DURATION)
+
+	def save(self, path: str):
+		profile = {
+			"bin_width": BIN_WIDTH,
+			"presses": [list(h) for h in self._presses],
+			"gaps": [list(h) for h in self._gaps],
+		}
+		try:
+			with open(path, "w") as f:
+				json.dump(profile, f, separators=(",", ":"))
+		except OSError:
+			logger.warning("Couldn't save gesture profile to {}".format(path))
+
+	def load(self, path: str) -> bool:
+		try:
+			with open(path) as f:
+				profile = json.load(f)
+		except (OSError, ValueError):
+			return False
+		if profile.get("bin_width") != BIN_WIDTH:
+			logger.warning("Ignoring gesture profile {} with different bins".format(path))
+			return False
+		for histograms, saved in ((self._presses, profile["presses"]), (self._gaps, profile["gaps"])):
+			for histogram, counts in zip(histograms, saved):
+				for ind, count in enumerate(counts[:NUM_BINS]):
+					histogram[ind] = count
+		if self._adaptive:
+			for value in range(NUM_SWITCHES):
+				self._long_press[value] = _threshold(self._presses[value], MIN_LONG_PRESS_DURATION, LONG_PRESS_DURATION)
+				self._double_press[value] = _threshold(self._gaps[value], MIN_DOUBLE_PRESS_DURATION, DOUBLE_PRESS_DURATION)
+		return True
+
+def _bin(seconds: float) -> int:
+	return min(NUM_BINS - 1, max(0, int(seconds / BIN_WIDTH)))
+
+def _threshold(histogram, lo: float, hi: float) -> float:
+	total = sum(histogram)
+	if total < MIN_SAMPLES:
+		return hi
+	needed = total * PERCENTILE
+	seen = 0
+	for ind, count in enumerate(histogram):
+		seen += count
+		if seen >= needed:
+			return min(hi, max(lo, (ind + 1) * BIN_WIDTH + MARGIN))
+	return hi
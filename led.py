@@ -1,9 +1,14 @@
 from typing import Callable
 from ableton.v2.base.dependency import depends
 from functools import partial
+import heapq
+import itertools
 import threading
 import logging
+import traceback
 from time import sleep
+from .clock import system_clock
+from .metrics import metrics, LED_CC_SENT, LED_CC_SUPPRESSED, LED_PREDICTED, LED_MISPREDICTED
 
 logger = logging.getLogger(__name__)
 
@@ -13,6 +18,9 @@ OFF_CC = 107
 FAST_BLINK = .3
 SLOW_BLINK = .8
 
+# Seconds a predicted LED state is given for Live to confirm it
+PREDICTION_TIMEOUT = .5
+
 """
 Stores the last fn call for each LED. If controller is active,
 also executes it.
@@ -22,6 +30,8 @@ def command(f):
 		self._last_commands[value] = partial(f, self, value, *a, **k)
 		if self._is_active:
 			self._last_commands[value]()
+		else:
+			metrics.count(LED_CC_SUPPRESSED)
 	return wrapper
 
 class LEDController:
@@ -35,8 +45,12 @@ class LEDController:
 	can also be used to redraw the LEDs, e.g. if the board lost power
 	temporarily.
 	"""
-	def __init__(self, send_cc, is_active = True, initialize_off = []):
+	def __init__(self, send_cc, is_active = True, initialize_off = [], clock = system_clock, expiry = None):
 		self._send_cc = send_cc
+		self._clock = clock
+		if expiry is None:
+			expiry = prediction_expiry if clock is system_clock else PredictionExpiry(clock=clock)
+		self._expiry = expiry
 		self._kill_events = {}
 		self._event_locks = {}
 		self._last_commands = {}
@@ -45,7 +59,11 @@ class LEDController:
 			self.off(value)
 
 	def copy(self, initialize_off = []):
-		return LEDController(self._send_cc, False, initialize_off)
+		return LEDController(self._send_cc, False, initialize_off, self._clock, self._expiry)
+
+	def prediction_expiry(self):
+		"""Checks the PredictedStates drawn on these LEDs, on this controller's clock"""
+		return self._expiry
 
 	@command
 	def on(self, value):
@@ -62,14 +80,14 @@ class LEDController:
 		self._kill(value)
 		def cb():
 			self._blink(value, speed)
-		threading.Thread(target = cb).start()
+		self._clock.start_thread(cb)
 
 	@command
 	def blink_off(self, value, speed = SLOW_BLINK):
 		self._kill(value)
 		def cb():
 			self._blink(value, speed, False)
-		threading.Thread(target = cb).start()
+		self._clock.start_thread(cb)
 
 	def activate(self):
 		self._is_active = True
@@ -82,9 +100,11 @@ class LEDController:
 			self._kill(value)
 
 	def _on(self, value):
+		metrics.count(LED_CC_SENT)
 		self._send_cc(ON_CC, value)
 
 	def _off(self, value):
+		metrics.count(LED_CC_SENT)
 		self._send_cc(OFF_CC, value)
 
 	def _blink(self, value, speed, on = True):
@@ -92,7 +112,7 @@ class LEDController:
 		cb1 = self._on if on else self._off
 		cb2 = self._off if on else self._on
 		if value not in self._kill_events:
-			self._kill_events[value] = threading.Event()
+			self._kill_events[value] = self._clock.event()
 			self._event_locks[value] = threading.Lock()
 		self._kill_events[value].clear()
 		while not self._kill_events[value].is_set():
@@ -113,3 +133,90 @@ class LEDController:
 			self._kill_events[value].set()
 			self._event_locks[value].release()
 
+
+class PredictedState:
+	"""
+	Puts the state an action is expected to lead to on an LED as soon as
+	the action is dispatched, rather than when Live calls the listener back.
+
+	read() returns the state Live reports and draw(state) shows a state on
+	the LED. The owner calls update() from its listener: a pending
+	prediction is settled there, and a wrong one is counted and rolled back
+	to the real state. A prediction Live never calls back about (e.g. a
+	device that can't turn on because its rack is off) is checked against
+	read() after PREDICTION_TIMEOUT.
+	"""
+	def __init__(self, read, draw, expiry = None):
+		self._read = read
+		self._draw = draw
+		self._expiry = expiry if expiry is not None else prediction_expiry
+		self._expected = None
+		self._deadline = None
+		self._drawn = None
+
+	def predict(self, state):
+		metrics.count(LED_PREDICTED)
+		self._expected = state
+		self._deadline = self._expiry.add(self)
+		self._show(state)
+
+	def update(self):
+		state = self._read()
+		if self._expected is not None:
+			if state != self._expected:
+				metrics.count(LED_MISPREDICTED)
+			self._expected = None
+		self._show(state)
+
+	def reset(self):
+		"""Forget any prediction and what's drawn, e.g. when the LED gets a new subject"""
+		self._expected = None
+		self._drawn = None
+
+	def expire(self, deadline):
+		if self._expected is not None and deadline == self._deadline:
+			self.update()
+
+	def _show(self, state):
+		if state != self._drawn:
+			self._drawn = state
+			self._draw(state)
+
+class PredictionExpiry:
+	"""Checks predictions Live hasn't confirmed in time, from a single thread"""
+	def __init__(self, timeout: float = PREDICTION_TIMEOUT, clock = system_clock):
+		self._timeout = timeout
+		self._clock = clock
+		self._queue = []
+		self._sequence = itertools.count()
+		self._lock = threading.Lock()
+		self._wake = None
+
+	def add(self, prediction: PredictedState) -> float:
+		deadline = self._clock.now() + self._timeout
+		with self._lock:
+			heapq.heappush(self._queue, (deadline, next(self._sequence), prediction))
+			if self._wake is None:
+				self._wake = self._clock.event()
+				self._clock.start_thread(self.run)
+		self._wake.set()
+		return deadline
+
+	def run(self):
+		while True:
+			due = []
+			with self._lock:
+				now = self._clock.now()
+				while len(self._queue) > 0 and self._queue[0][0] <= now:
+					deadline, _, prediction = heapq.heappop(self._queue)
+					due.append((prediction, deadline))
+				timeout = self._queue[0][0] - now if len(self._queue) > 0 else None
+			for prediction, deadline in due:
+				try:
+					prediction.expire(deadline)
+				except Exception:
+					logger.error("Caught exception checking LED prediction: {}".format(traceback.format_exc()))
+			self._wake.wait(timeout)
+			self._wake.clear()
+
+prediction_expiry = PredictionExpiry()
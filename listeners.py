@@ -0,0 +1,93 @@
+from ableton.v2.base import liveobj_valid
+from .metrics import metrics, LISTENERS
+import logging
+
+logger = logging.getLogger(__name__)
+
+# name -> (add, remove, has) method names. Made once: the interpreter's
+# attribute cache keeps every name string it's looked up with alive.
+_methods = {}
+
+def _method_names(name: str):
+	methods = _methods.get(name)
+	if methods is None:
+		methods = _methods[name] = (
+			"add_{}_listener".format(name), "remove_{}_listener".format(name), "{}_has_listener".format(name))
+	return methods
+
+def add_listener(subject, name: str, callback) -> bool:
+	"""
+	Adds callback as subject's name listener (e.g. "devices", "has_clip")
+	unless it already is, and counts it on the LISTENERS gauge. Every Live
+	listener the script holds goes through here or a Subscription, so the
+	gauge (and the watchdog) sees all of them.
+	"""
+	add, _, has = _method_names(name)
+	if getattr(subject, has)(callback):
+		return False
+	getattr(subject, add)(callback)
+	metrics.adjust(LISTENERS, 1)
+	return True
+
+def remove_listener(subject, name: str, callback):
+	"""
+	Takes a listener added with add_listener off subject. A subject Live
+	has deleted took its listeners with it, so it's only uncounted.
+	"""
+	if not liveobj_valid(subject):
+		metrics.adjust(LISTENERS, -1)
+		return
+	_, remove, has = _method_names(name)
+	if getattr(subject, has)(callback):
+		getattr(subject, remove)(callback)
+		metrics.adjust(LISTENERS, -1)
+
+class Subscription:
+	"""
+	One Live listener (e.g. "is_active", "value", "playing_status") on a
+	subject that can change: a device, a parameter, a clip, the song.
+
+	A mode that's not on the board suspends its subscriptions, which takes
+	the listeners off Live's objects altogether. resume() puts them back and
+	calls the callback once, so whatever it drives catches up with what
+	changed while it wasn't listening.
+	"""
+	def __init__(self, name: str, callback):
+		self._name = name
+		self._callback = callback
+		self._subject = None
+		self._hooked = False
+		self._suspended = False
+
+	def subject(self):
+		return self._subject
+
+	def set_subject(self, subject):
+		if subject == self._subject:
+			return
+		self._unhook()
+		self._subject = subject
+		self._hook()
+
+	def suspend(self):
+		self._unhook()
+		self._suspended = True
+
+	def resume(self):
+		if not self._suspended:
+			return
+		self._suspended = False
+		self._hook()
+		if self._subject is not None:
+			self._callback()
+
+	def _hook(self):
+		if self._subject is None or self._suspended or self._hooked:
+			return
+		self._hooked = add_listener(self._subject, self._name, self._callback)
+
+	def _unhook(self):
+		if not self._hooked:
+			return
+		self._hooked = False
+		remove_listener(self._subject, self._name, self._callback)
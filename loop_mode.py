@@ -2,6 +2,10 @@ from .footswitch import Layout, FootSwitch, EventType, top_row
 from .board import Mode
 from .led import LEDController
 from functools import partial
+from .trace import tracer
+from .device_index import device_index
+from .metrics import metrics, PARAMETER_WRITES
+from .listeners import Subscription
 import Live
 import logging
 
@@ -11,34 +15,55 @@ NOTE_OFF = 0x80 | CHAN
 
 logger = logging.getLogger(__name__)
 
+TRACE_FOUND_DEVICE = tracer.event("Found looper device {} on chain {}")
+
 class LoopMode(Mode):
 	"""
-	Controls two Looper Devices. The problem with this controller is that it can only
-	set the state of the Looper device via Live's API. This will only work when the
-	Live Set is playing.
+	Controls the loopers in the first rack with #loop in its name. Each
+	chain of the rack holds one looper, either Live's Looper or a Max
+	looper with "enable" and "bars" parameters. The problem with this
+	controller is that it can only set the state of the Looper device
+	via Live's API. This will only work when the Live Set is playing.
+
+	[1-4]: Looper on chain 1-4 (on release) | hold to stop it
+	[5]: Tap Tempo | hold to Toggle metronome
+	[6-10]: Bar quantization of the Max loopers
 	"""
+	LOOPER_FOOTSWITCHES = [FootSwitch.ONE, FootSwitch.TWO, FootSwitch.THREE, FootSwitch.FOUR]
+
 	def __init__(self, leds: LEDController):
 		super(LoopMode, self).__init__(leds)
 		self._leds = leds
 		self._song = Live.Application.get_application().get_document()
-		self._song.add_metronome_listener(self._metronome_changed)
+		self._metronome = Subscription("metronome", self._metronome_changed)
+		self._metronome.set_subject(self._song)
 		self._metronome_changed()
-		self._looper1 = MaxLooper()
-		self._looper2 = MaxLooper()
-		self._bars_param = None
+		self._loopers = []
+		self._bars = Subscription("value", self._update_bars)
+		self._lit_bar = None
+		self._layout_changed_callback = None
+
+	def activate(self):
+		self._metronome.resume()
+		self._bars.resume()
+		super(LoopMode, self).activate()
+
+	def deactivate(self):
+		super(LoopMode, self).deactivate()
+		self._metronome.suspend()
+		self._bars.suspend()
 
 	def get_layout(self):
 		l = Layout()
-		# looper buttons
-		l.listen(FootSwitch.ONE, EventType.DOWN, self._looper1.start)
-		l.listen(FootSwitch.THREE, EventType.DOWN, self._looper2.start)
-		
+		# looper buttons. PRESS rather than DOWN, which also starts a hold, so
+		# holding to stop doesn't first record or overdub
+		for footswitch, looper in zip(self.LOOPER_FOOTSWITCHES, self._loopers):
+			l.listen(footswitch, EventType.PRESS, looper.press)
+			l.listen(footswitch, EventType.LONG_PRESS, looper.stop)
+
 		# bar quantization
-		l.listen(FootSwitch.SIX, EventType.PRESS, partial(self._set_bars, 0))
-		l.listen(FootSwitch.SEVEN, EventType.PRESS, partial(self._set_bars, 1))
-		l.listen(FootSwitch.EIGHT, EventType.PRESS, partial(self._set_bars, 2))
-		l.listen(FootSwitch.NINE, EventType.PRESS, partial(self._set_bars, 3))
-		l.listen(FootSwitch.TEN, EventType.PRESS, partial(self._set_bars, 4))
+		for ind, footswitch in enumerate(top_row()):
+			l.listen(footswitch, EventType.PRESS, partial(self._set_bars, ind))
 
 		# tap tempo
 		def tap(*a):
@@ -47,6 +72,9 @@ class LoopMode(Mode):
 		l.listen(FootSwitch.FIVE, EventType.LONG_PRESS, self._toggle_metronome)
 		return l
 
+	def set_layout_changed_callback(self, callback):
+		self._layout_changed_callback = callback
+
 	def _metronome_changed(self):
 		if self._song.metronome:
 			self._leds.on(FootSwitch.FIVE.led_value())
@@ -57,18 +85,24 @@ class LoopMode(Mode):
 		self._song.metronome = not self._song.metronome
 
 	def _set_bars(self, value, *a):
-		self._looper1.set_bars(value)
-		self._looper2.set_bars(value)
+		for looper in self._loopers:
+			looper.set_bars(value)
 
 	def _update_bars(self):
-		for ind, fs in enumerate(top_row()):
-			if ind == self._bars_param.value:
-				self._leds.on(fs.led_value())
-			else:
-				self._leds.off(fs.led_value())
-
+		"""Only touches the LEDs whose state changed"""
+		bars_param = self._bars.subject()
+		bar = None if bars_param is None else int(bars_param.value)
+		if bar == self._lit_bar:
+			return
+		footswitches = top_row()
+		if self._lit_bar is not None and self._lit_bar < len(footswitches):
+			self._leds.off(footswitches[self._lit_bar].led_value())
+		if bar is not None and bar < len(footswitches):
+			self._leds.on(footswitches[bar].led_value())
+		self._lit_bar = bar
 
 	def set_track(self, track):
+		self._clear_loopers()
 		for rack in track.devices:
 			if not isinstance(rack, Live.RackDevice.RackDevice):
 				continue
@@ -77,79 +111,132 @@ class LoopMode(Mode):
 			if "#loop" not in rack.name:
 				continue
 
-			for device in rack.chains[0].devices:
-				self._looper1.set_device(device)
-				logger.info("Found device {}".format(device.class_name))
-				logger.info("--- Looper methods ----\n{}\n---------".format(dir(device)))
-				for p in device.parameters:
-					logger.info("Parameter: {} min {} max {} value {}".format(p.name, p.min, p.max, p.value))
-					if p.name == "bars":
-						p.add_value_listener(self._update_bars)
-						self._bars_param = p
-						self._update_bars()
-
-			for device in rack.chains[1].devices:
-				self._looper2.set_device(device)
-
-	def print_looper(self):
-		for p in self._looper.parameters:
-			logger.info("Parameter: {} {}".format(p.name, p.value))
+			for chain_ind, chain in enumerate(rack.chains):
+				looper = create_looper(chain.devices, self._song)
+				if looper is None:
+					continue
+				tracer.trace(TRACE_FOUND_DEVICE, looper.device().class_name, chain_ind)
+				self._loopers.append(looper)
+				if self._bars.subject() is None and looper.bars_parameter() is not None:
+					self._bars.set_subject(looper.bars_parameter())
+			break
+
+		if len(self._loopers) > len(self.LOOPER_FOOTSWITCHES):
+			logger.warning("LoopMode can only control {} loopers but found {}. Ignoring the rest."
+				.format(len(self.LOOPER_FOOTSWITCHES), len(self._loopers)))
+		self._update_bars()
+		if self._layout_changed_callback is not None:
+			self._layout_changed_callback()
+
+	def _clear_loopers(self):
+		self._bars.set_subject(None)
+		self._loopers = []
+
+def create_looper(devices, song):
+	"""Returns a looper for the first device in the list that is one, or None"""
+	for device in devices:
+		if device.class_name == "Looper":
+			looper = Looper(song)
+		else:
+			looper = MaxLooper()
+		if looper.set_device(device):
+			return looper
+	return None
 
 class MaxLooper:
+	"""Max for Live looper with "enable" and "bars" parameters"""
 	def __init__(self):
 		self._device = None
 		self._enable = None
 		self._bars = None
 
-	def set_device(self, device):
+	def set_device(self, device) -> bool:
+		parameters = device_index.parameters(device)
+		if "enable" not in parameters:
+			return False
 		self._device = device
-		for p in self._device.parameters:
-			if p.name == "enable":
-				self._enable = p
-			if p.name == "bars":
-				self._bars = p
+		self._enable = parameters["enable"]
+		self._bars = parameters.get("bars")
+		return True
+
+	def device(self):
+		return self._device
+
+	def bars_parameter(self):
+		return self._bars
 
 	def set_bars(self, value):
+		if self._bars is None:
+			return
+		metrics.count(PARAMETER_WRITES)
 		self._bars.value = value
 
-	def start(self, *a):
-		if self._device is None:
+	def press(self, *a):
+		if self._enable is None:
 			return
+		metrics.count(PARAMETER_WRITES)
 		self._enable.value = 1
 
+	def stop(self, *a):
+		if self._enable is None:
+			return
+		metrics.count(PARAMETER_WRITES)
+		self._enable.value = 0
+
 
 class Looper:
+	"""
+	Live's native Looper. Pressing steps through
+	stopped -> recording -> playing <-> overdubbing
+	"""
 	# the Looper's parameter that gets / sets its state
-	STATE_PARAMETER_IND = 1
+	STATE_PARAMETER = "State"
 
 	STATE_STOPPED = 0
 	STATE_RECORDING = 1
 	STATE_PLAYING = 2
 	STATE_OVERDUBBING = 3
 
+	_next_state = {
+		STATE_STOPPED: STATE_RECORDING,
+		STATE_RECORDING: STATE_PLAYING,
+		STATE_PLAYING: STATE_OVERDUBBING,
+		STATE_OVERDUBBING: STATE_PLAYING,
+	}
+
 	def __init__(self, song):
-		self._looper = None
+		self._device = None
+		self._state = None
 		self._song = song
 
-	def set_looper(self, looper):
+	def set_device(self, device) -> bool:
 		if device.class_name != "Looper":
 			raise RuntimeError("{} is a {}, not a Looper".format(device.name, device.class_name))
-		self._looper = looper
+		self._state = device_index.parameter(device, self.STATE_PARAMETER)
+		if self._state is None:
+			return False
+		self._device = device
+		return True
 
-	def left(self, *a):
-		if not self._song.is_playing:
-			self._song.continue_playing()
-		state = self._looper.parameters[STATE_PARAMETER_IND]
-		if state.value == STATE_RECORDING:
-			state.value = STATE_STOPPED
-		else:
-			state.value = STATE_RECORDING
+	def device(self):
+		return self._device
 
-	def right(self, *a):
+	def bars_parameter(self):
+		return None
+
+	def set_bars(self, value):
+		pass
+
+	def press(self, *a):
+		if self._state is None:
+			return
 		if not self._song.is_playing:
 			self._song.continue_playing()
-		state = self._looper.parameters[STATE_PARAMETER_IND]
-		if state.value == STATE_OVERDUBBING:
-			state.value = STATE_STOPPED
-		else:
-			state.value = STATE_OVERDUBBING
\ No newline at end of file
+		metrics.count(PARAMETER_WRITES)
+		self._state.value = self._next_state.get(int(self._state.value), self.STATE_RECORDING)
+
+	def stop(self, *a):
+		if self._state is None:
+			return
+		metrics.count(PARAMETER_WRITES)
+		self._state.value = self.STATE_STOPPED
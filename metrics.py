@@ -0,0 +1,106 @@
+from array import array
+import logging
+import socket
+import struct
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+NUM_SWITCHES = 12
+NUM_EVENT_TYPES = 5
+
+# Counter slots. Switch events are a flat block of NUM_SWITCHES x NUM_EVENT_TYPES
+# counters, indexed with switch_event_index.
+SWITCH_EVENTS 		= 0
+EXPRESSION_CC 		= SWITCH_EVENTS + NUM_SWITCHES * NUM_EVENT_TYPES
+PARAMETER_WRITES 	= EXPRESSION_CC + 1
+LED_CC_SENT 		= PARAMETER_WRITES + 1
+LED_CC_SUPPRESSED 	= LED_CC_SENT + 1
+DEBOUNCE_REJECTED 	= LED_CC_SUPPRESSED + 1
+INPUT_OVERFLOW 		= DEBOUNCE_REJECTED + 1
+CC_COALESCED 		= INPUT_OVERFLOW + 1
+UNDO_STEPS 			= CC_COALESCED + 1
+LED_PREDICTED 		= UNDO_STEPS + 1
+LED_MISPREDICTED 	= LED_PREDICTED + 1
+NUM_COUNTERS 		= LED_MISPREDICTED + 1
+
+# Gauge slots
+THREADS 			= 0
+LISTENERS 			= 1
+QUEUE_DEPTH 		= 2
+NUM_GAUGES 			= 3
+
+# magic, version, sequence, timestamp, counter count, gauge count
+HEADER = struct.Struct("<4sBIdHH")
+MAGIC = b"FCBM"
+VERSION = 1
+
+def switch_event_index(switch_value: int, event_type_value: int) -> int:
+	return SWITCH_EVENTS + (switch_value - 1) * NUM_EVENT_TYPES + (event_type_value - 1)
+
+class Metrics:
+	"""
+	Counters and gauges kept in preallocated arrays. Counters only ever go up;
+	rates (events/sec etc.) are left to the collector, which diffs consecutive
+	datagrams. Updating a slot is a single array increment so it's cheap enough
+	to do on the MIDI path.
+	"""
+	def __init__(self):
+		self.counters = array("Q", [0]) * NUM_COUNTERS
+		self.gauges = array("q", [0]) * NUM_GAUGES
+		self._samplers = {}
+
+	def count(self, index: int, n: int = 1):
+		self.counters[index] += n
+
+	def adjust(self, index: int, delta: int):
+		self.gauges[index] += delta
+
+	def set_sampler(self, index: int, sampler):
+		"""Have a gauge read from sampler() each time the metrics are exported"""
+		self._samplers[index] = sampler
+
+	def pack(self, sequence: int) -> bytes:
+		for index, sampler in list(self._samplers.items()):
+			try:
+				self.gauges[index] = sampler()
+			except Exception:
+				pass
+		header = HEADER.pack(MAGIC, VERSION, sequence, time.time(), NUM_COUNTERS, NUM_GAUGES)
+		return header + self.counters.tobytes() + self.gauges.tobytes()
+
+metrics = Metrics()
+metrics.set_sampler(THREADS, threading.active_count)
+
+class MetricsExporter:
+	"""
+	Periodically sends the metrics as a single UDP datagram to a local port.
+	Runs on its own thread so nothing here touches the MIDI path.
+	"""
+	def __init__(self, port: int, host: str = "127.0.0.1", interval: float = 1.0, source: Metrics = metrics):
+		self._address = (host, port)
+		self._interval = interval
+		self._metrics = source
+		self._sequence = 0
+		self._socket = None
+		self._killed = threading.Event()
+
+	def start(self):
+		self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+		self._socket.setblocking(False)
+		threading.Thread(target=self.run, daemon=True).start()
+
+	def stop(self):
+		self._killed.set()
+
+	def run(self):
+		logger.info("Exporting metrics to {}:{}".format(*self._address))
+		while not self._killed.wait(self._interval):
+			self._sequence += 1
+			try:
+				self._socket.sendto(self._metrics.pack(self._sequence), self._address)
+			except OSError:
+				pass
+		self._socket.close()
+		logger.info("Metrics exporter stopped")
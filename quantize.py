@@ -0,0 +1,101 @@
+from .footswitch import event_time
+from enum import Enum
+from functools import partial
+from math import ceil
+from time import monotonic
+import heapq
+import itertools
+import logging
+import threading
+import traceback
+import Live
+
+logger = logging.getLogger(__name__)
+
+# A press landing this many beats after a grid line counts as on it, and fires right away
+LATE_GRACE = 0.1
+
+# Weight of each new sample in the moving average of the dispatch delay
+LATENCY_SMOOTHING = 0.2
+
+class Quantization(Enum):
+	BEAT 	= 1
+	BAR 	= 2
+
+class ActionScheduler:
+	"""
+	Delays layout callbacks to the next beat or bar of the song.
+
+	The grid position is worked out from when the footswitch MIDI actually
+	arrived (see footswitch.event_time), not from when the notifier thread got
+	round to the callback. Callbacks are dispatched from a single scheduler
+	thread, early by the measured delay between a callback falling due and it
+	finishing, so the action itself lands on the grid.
+
+	When the song isn't playing there's no grid, and callbacks run immediately.
+	"""
+	def __init__(self, song = None):
+		self._song = song if song is not None else Live.Application.get_application().get_document()
+		self._queue = []
+		self._sequence = itertools.count()
+		self._condition = threading.Condition()
+		self._latency = 0.0
+		self._killed = False
+		threading.Thread(target=self.run, daemon=True).start()
+
+	def quantize(self, callback, grid: Quantization = Quantization.BEAT):
+		"""Wrap a layout callback so it fires on the next grid line"""
+		return partial(self.schedule, callback, grid)
+
+	def schedule(self, callback, grid: Quantization, *a):
+		now = monotonic()
+		if not self._song.is_playing:
+			self._run(callback, a)
+			return
+		beats_per_second = self._song.tempo / 60.0
+		song_time = self._song.current_song_time
+		pressed_at = song_time - (now - event_time()) * beats_per_second
+		quantum = self._quantum(grid)
+		target = ceil(pressed_at / quantum) * quantum
+		if pressed_at - (target - quantum) <= LATE_GRACE:
+			target -= quantum
+		due = now + (target - song_time) / beats_per_second - self._latency
+		if due <= now:
+			self._run(callback, a)
+			return
+		with self._condition:
+			heapq.heappush(self._queue, (due, next(self._sequence), callback, a))
+			self._condition.notify()
+
+	def latency(self) -> float:
+		return self._latency
+
+	def stop(self):
+		with self._condition:
+			self._killed = True
+			self._condition.notify()
+
+	def run(self):
+		while True:
+			with self._condition:
+				while not self._killed and (len(self._queue) == 0 or self._queue[0][0] > monotonic()):
+					timeout = None if len(self._queue) == 0 else self._queue[0][0] - monotonic()
+					self._condition.wait(timeout)
+				if self._killed:
+					return
+				due, _, callback, a = heapq.heappop(self._queue)
+			self._run(callback, a)
+			delay = monotonic() - due
+			self._latency += LATENCY_SMOOTHING * (delay - self._latency)
+
+	def _quantum(self, grid: Quantization) -> float:
+		beat = 4.0 / self._song.signature_denominator
+		if grid is Quantization.BAR:
+			return beat * self._song.signature_numerator
+		return beat
+
+	def _run(self, callback, a):
+		try:
+			callback(*a)
+		except Exception:
+			logger.error("Caught exception while running scheduled action: {}".format(traceback.format_exc()))
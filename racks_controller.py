@@ -2,14 +2,25 @@ from .led import LEDController
 from .footswitch import FootSwitch, Layout, EventType, bottom_row, top_row
 from .effects_mode import DeviceEnabledLED
 from .board import Mode
-from ableton.v2.base import liveobj_valid
+from .trace import tracer
+from .device_index import device_index, parameter_values, NameListeners
+from .metrics import metrics, PARAMETER_WRITES
+from .listeners import Subscription, add_listener, remove_listener
+from .expression import ExpressionGroup
+from .undo import undo_grouper
 
 from functools import partial
 import logging
+import re
 
 
 logger = logging.getLogger(__name__)
 
+TRACE_CLEAR_RACK = tracer.event("Clearing rack {} of {} racks")
+
+# el / er, optionally followed by <min>-<max> and c<curve>
+EXPRESSION_SPEC = re.compile(r"^e([lr])(?:(\d+(?:\.\d+)?)-(\d+(?:\.\d+)?))?(?:c(\d+(?:\.\d+)?))?$")
+
 
 class RacksControllerMode(Mode):
 	"""
@@ -41,29 +52,49 @@ class RacksControllerMode(Mode):
 	s<val>: set to a specific value
 	el: assign to left expression pedal
 	er: assign to right expression pedal
+	el<min>-<max>c<curve>: same, over min-max (min can be above max)
+	    with the pedal position raised to curve. Both parts are optional.
 
 	So of a macro name might be:
 	Wah Amount #s5hel
 
 	This would assign Wah Amount to the left
 	expression pedal when stomp 5 is held.
+
+	Every macro assigned to the same pedal on the same event is driven
+	together, e.g. Wah #s5hel, Volume #s5hel127-64 and Mix #s5hel0-100c2.
+
+	Patch changes can be quantized to the song's beat or bar by
+	passing an ActionScheduler and a Quantization.
 	"""
-	def __init__(self, leds: LEDController, scheduler):
+	def __init__(self, leds: LEDController, scheduler, action_scheduler = None, patch_quantization = None):
 		super(RacksControllerMode, self).__init__(leds)
 		self._leds = leds
 		self._track = None
 		self._racks = []
 		self._rack_ind = None
+		self._named_parameters = []
+		self._names = NameListeners(self._update_devices)
 		self._stomps = [RackMacroStomp(
 			fs, 
 			leds, 
 			self._set_left_expression_callback, 
 			self._set_right_expression_callback
 		) for fs in bottom_row()]
-		self._patches = PatchSelector(top_row(), leds, scheduler, self._set_rack)
+		self._patches = PatchSelector(top_row(), leds, scheduler, self._set_rack, action_scheduler, patch_quantization)
 		self._left_expression_callback = None
 		self._right_expression_callback = None
 
+	def activate(self):
+		for s in self._stomps: s.resume()
+		self._patches.resume()
+		super(RacksControllerMode, self).activate()
+
+	def deactivate(self):
+		super(RacksControllerMode, self).deactivate()
+		for s in self._stomps: s.suspend()
+		self._patches.suspend()
+
 	def get_layout(self):
 		l = Layout()
 		for s in self._stomps: l.union_with(s.get_layout())
@@ -97,116 +128,182 @@ class RacksControllerMode(Mode):
 
 	def set_track(self, track):
 		self._clear_devices()
+		if self._track is not None and self._track != track:
+			remove_listener(self._track, "devices", self._update_devices)
 		self._track = track
-		self._track.add_devices_listener(self._update_devices)
+		add_listener(self._track, "devices", self._update_devices)
 		self._update_devices()
 
+	def clear(self):
+		self._clear_devices()
+		if self._track is not None:
+			remove_listener(self._track, "devices", self._update_devices)
+		self._track = None
+
 	def _update_devices(self):
+		"""
+		Diffs the track's racks against the ones we're bound to. Only patch
+		slots whose rack changed get rebound, and the selected rack stays
+		selected as long as it's still on the track.
+		"""
 		if self._track is None:
 			return
 
-		self._clear_devices()
-		
-		for device in self._track.devices:
-			device.add_name_listener(self._update_devices)
-			if "#rack" in device.name:
-				self._racks.append(device)
+		devices = list(self._track.devices)
+		self._names.update(devices)
+		racks = [device for device in devices if "#rack" in device.name]
+		if racks == self._racks:
+			return
 
-		self._patches.set_devices(self._racks)
-		self._patches.set_device_ind(0)
+		current = self._racks[self._rack_ind] if self._rack_ind is not None else None
+		self._patches.set_devices(racks)
+		if current is not None and current in racks:
+			self._racks = racks
+			self._rack_ind = racks.index(current)
+			# a new or duplicated rack comes in with its own Device On
+			self._patches.reselect(self._rack_ind)
+		else:
+			self._clear_rack()
+			self._racks = racks
+			self._patches.set_device_ind(0)
 
 	def _clear_devices(self):
 		if self._track is None:
 			return
 
-		for device in self._track.devices:
-			if device.name_has_listener(self._update_devices):
-				device.remove_name_listener(self._update_devices)
-
+		self._names.clear()
 		self._clear_rack()
+		self._patches.clear()
 		self._racks = []
 
 
 	def _set_rack(self, rack_ind):
 		self._clear_rack()
 		self._rack_ind = rack_ind
-		self._racks[rack_ind].add_parameters_listener(self._update_parameters)
+		add_listener(self._racks[rack_ind], "parameters", self._update_parameters)
 		self._update_parameters()
 
 	def _update_parameters(self):
 		for stomp in self._stomps:
 			stomp.set_rack(self._racks[self._rack_ind])
+		self._unlisten_parameters()
 		for param in self._racks[self._rack_ind].parameters:
-			param.add_name_listener(self._update_stomps)
+			if add_listener(param, "name", self._update_stomps):
+				self._named_parameters.append(param)
 		self._layout_changed_callback()
 
+	def _unlisten_parameters(self):
+		for param in self._named_parameters:
+			remove_listener(param, "name", self._update_stomps)
+		self._named_parameters = []
+
 	def _update_stomps(self):
 		for s in self._stomps: s.update_parameters()
 		self._layout_changed_callback()
 
 	def _clear_rack(self):
-		logger.info("Rack ind {} racks {}".format(self._rack_ind, self._racks))
+		tracer.trace(TRACE_CLEAR_RACK, self._rack_ind, len(self._racks))
 		if self._rack_ind is None:
 			return
 
-		if liveobj_valid(self._racks[self._rack_ind]):
-			if self._racks[self._rack_ind].parameters_has_listener(self._update_parameters):
-				self._racks[self._rack_ind].remove_parameters_listener(self._update_parameters)
-
-			for param in self._racks[self._rack_ind].parameters:
-				if param.name_has_listener(self._update_stomps):
-					param.remove_name_listener(self._update_stomps)
-
+		remove_listener(self._racks[self._rack_ind], "parameters", self._update_parameters)
+		self._unlisten_parameters()
 		self._rack_ind = None
 
 class PatchSelector:
-	def __init__(self, footswitches, leds: LEDController, scheduler, callback = None):
+	def __init__(self, footswitches, leds: LEDController, scheduler, callback = None, action_scheduler = None, quantization = None):
 		self._footswitches = footswitches
+		self._action_scheduler = action_scheduler
+		self._quantization = quantization
 		self._leds = [DeviceEnabledLED(fs, leds) for fs in footswitches]
+		self._leds_by_footswitch = dict(zip(footswitches, self._leds))
 		self._indexes = {fs: i for i, fs in enumerate(footswitches)}
 		self._ons = {}
+		self._devices = []
 		self._scheduler = scheduler
 		self._callback = callback
 
 	def get_layout(self):
 		layout = Layout()
 		for footswitch in self._footswitches:
-			layout.listen(footswitch, EventType.PRESS, partial(self._pressed, footswitch))
+			cb = partial(self._pressed, footswitch)
+			if self._action_scheduler is not None and self._quantization is not None:
+				cb = self._action_scheduler.quantize(cb, self._quantization)
+			layout.listen(footswitch, EventType.PRESS, cb)
 		return layout
 
-	def set_devices(self, devices):		
-		self.clear()
-
+	def set_devices(self, devices):
+		"""Rebinds only the slots whose device changed"""
 		if len(devices) > len(self._footswitches):
 			logger.warning(
 				"Patch can only control {} devices but received {}. Ignoring the rest."
 					.format(len(self._footswitches), len(devices)))
 
-		for footswitch, led, device in zip(self._footswitches, self._leds, devices):
+		devices = list(devices[:len(self._footswitches)])
+		for ind, (footswitch, led) in enumerate(zip(self._footswitches, self._leds)):
+			device = devices[ind] if ind < len(devices) else None
+			previous = self._devices[ind] if ind < len(self._devices) else None
+			if device == previous:
+				continue
+			self._unwatch(footswitch)
+			if device is None:
+				led.clear()
+				continue
 			led.listen_to_device(device)
-			for p in device.parameters:
-				if p.name == "Device On":
-					self._ons[footswitch] = p
+			on = device_index.parameter(device, "Device On")
+			if on is not None:
+				parameter_values.watch(on)
+				self._ons[footswitch] = on
+		self._devices = devices
 
 	def set_device_ind(self, device_ind):
 		if device_ind >= len(self._footswitches):
 			return
 		self._scheduler(0, partial(self._pressed, self._footswitches[device_ind]))
 
+	def reselect(self, device_ind):
+		"""
+		Puts the patches' Device On back to only device_ind on, after the
+		devices changed, without calling back: the selected rack hasn't. If
+		device_ind moved past the last footswitch it stays on, and every patch
+		slot is turned off.
+		"""
+		footswitch = self._footswitches[device_ind] if device_ind < len(self._footswitches) else None
+		self._scheduler(0, partial(self._select, footswitch))
+
 	def clear(self):
-		self._ons = {}
+		for footswitch in list(self._ons.keys()):
+			self._unwatch(footswitch)
+		self._devices = []
 		for led in self._leds:
 			led.clear()
 
+	def suspend(self):
+		for led in self._leds:
+			led.suspend()
+
+	def resume(self):
+		for led in self._leds:
+			led.resume()
+
+	def _unwatch(self, footswitch):
+		on = self._ons.pop(footswitch, None)
+		if on is not None:
+			parameter_values.unwatch(on)
+
 	def _pressed(self, footswitch, *a):
 		if footswitch not in self._ons:
 			return
-		for fs, on in self._ons.items():
-			if fs == footswitch:
-				on.value = 1.0
-				self._callback(self._indexes[fs])
-			else:
-				on.value = 0.0
+		with undo_grouper.group():
+			self._select(footswitch)
+			self._callback(self._indexes[footswitch])
+
+	def _select(self, footswitch):
+		"""Turns on footswitch's patch and the others off. None turns them all off."""
+		with undo_grouper.group():
+			for fs, on in self._ons.items():
+				if parameter_values.write(on, 1.0 if fs == footswitch else 0.0):
+					self._leds_by_footswitch[fs].predict(fs == footswitch)
 
 class RackMacroStomp:
 	"""
@@ -230,15 +327,21 @@ class RackMacroStomp:
 		self._rack = None
 		self._set_left_expression_callback = set_left_expression_callback
 		self._set_right_expression_callback = set_right_expression_callback
+		self._event_actions = {}
 		self._clear_parameters()
 
 	def _clear_parameters(self):
+		for actions in self._event_actions.values():
+			for action in actions:
+				action.clear()
 		self._event_actions = {}
+		self._expression_groups = {}
 
 	def get_layout(self):
 		def execute_all(actions, *a):
-			for action in actions:
-				action.execute()
+			with undo_grouper.group():
+				for action in actions:
+					action.execute()
 
 		l = Layout()
 		for event, actions in self._event_actions.items():
@@ -249,6 +352,12 @@ class RackMacroStomp:
 		self._rack = rack
 		self.update_parameters()
 
+	def suspend(self):
+		self._led.suspend()
+
+	def resume(self):
+		self._led.resume()
+
 	def update_parameters(self):
 		self._clear_parameters()
 		for param in self._rack.parameters:
@@ -282,10 +391,24 @@ class RackMacroStomp:
 
 				action = Toggle(param, float(min_max[0]), float(min_max[1]))
 				self._led.watch_parameter(param, (float(min_max[0]) + float(min_max[1])) / 2)
-			elif action_spec == "el":
-				action = SetExpressionCallback(param, self._set_left_expression_callback)
-			elif action_spec == "er":
-				action = SetExpressionCallback(param, self._set_right_expression_callback)
+			elif EXPRESSION_SPEC.match(action_spec):
+				side, lo, hi, curve = EXPRESSION_SPEC.match(action_spec).groups()
+				group = self._expression_groups.get((event, side))
+				group_is_new = group is None
+				if group_is_new:
+					group = ExpressionGroup()
+					self._expression_groups[(event, side)] = group
+				group.add_target(
+					param,
+					float(lo) if lo is not None else None,
+					float(hi) if hi is not None else None,
+					float(curve) if curve is not None else 1.0)
+				if not group_is_new:
+					continue
+				if side == "l":
+					action = SetExpressionCallback(group, self._set_left_expression_callback)
+				else:
+					action = SetExpressionCallback(group, self._set_right_expression_callback)
 			elif action_spec.startswith("s"):
 				if not action_spec[1:].isnumeric():
 					continue
@@ -297,22 +420,25 @@ class RackMacroStomp:
 				self._event_actions[event] = []
 			self._event_actions[event].append(action)
 
-	def _parameter_expression_callback(self, param):
-		def cb(val):
-			param.value = val
-		return cb
-
 class Action:
 	def execute(self):
 		pass
 
+	def clear(self):
+		"""Called when the action is thrown away"""
+		pass
+
 class SetValue(Action):
 	def __init__(self, param, value):
 		self._param = param
 		self._value = value
+		parameter_values.watch(param)
 
 	def execute(self):
-		self._param.value = self._value
+		parameter_values.write(self._param, self._value)
+
+	def clear(self):
+		parameter_values.unwatch(self._param)
 
 class Toggle(Action):
 	def __init__(self, param, lo = None, hi = None):
@@ -321,21 +447,21 @@ class Toggle(Action):
 		self._max = hi if hi is not None else param.max
 
 	def execute(self):
+		metrics.count(PARAMETER_WRITES)
 		if self._param.value < (self._min + self._max) / 2:
 			self._param.value = self._max
 		else:
 			self._param.value = self._min
 
 class SetExpressionCallback(Action):
-	def __init__(self, param, set_expression_callback):
-		self._param = param
+	"""Points an expression pedal at a group of parameters"""
+	def __init__(self, group: ExpressionGroup, set_expression_callback):
+		self._group = group
 		self._set_expression_callback = set_expression_callback
 
 	def execute(self):
-		self._set_expression_callback(self._cb)
-
-	def _cb(self, value):
-		self._param.value = value
+		self._group.reset()
+		self._set_expression_callback(self._group)
 
 
 class RackMacroLED:
@@ -346,32 +472,34 @@ class RackMacroLED:
 	def __init__(self, footswitch: FootSwitch, leds: LEDController):
 		self._on = partial(leds.on, footswitch.led_value())
 		self._off = partial(leds.off, footswitch.led_value())
-		self._parameter = None
+		self._value = Subscription("value", self._update)
 		self._threshold = 0
 		self._is_on = False
 
 	def watch_parameter(self, parameter, threshold):
 		self.clear_parameter()
-		self._parameter = parameter
 		self._threshold = threshold
-		self._parameter.add_value_listener(self._update)
+		self._value.set_subject(parameter)
 		self._update()
 
 	def clear_parameter(self):
-		if self._parameter is None:
+		if self._value.subject() is None:
 			return
+		self._value.set_subject(None)
+		self._off()
+		self._is_on = False
 
-		if liveobj_valid(self._parameter):
-			if self._parameter.value_has_listener(self._update):
-				self._parameter.remove_value_listener(self._update)
+	def suspend(self):
+		self._value.suspend()
 
-		self._parameter = None
-		self._off()
+	def resume(self):
+		self._value.resume()
 
 	def _update(self):
-		if self._parameter.value > self._threshold and not self._is_on:
+		value = self._value.subject().value
+		if value > self._threshold and not self._is_on:
 			self._on()
 			self._is_on = True
-		elif self._parameter.value <= self._threshold and self._is_on:
+		elif value <= self._threshold and self._is_on:
 			self._off()
 			self._is_on = False
\ No newline at end of file
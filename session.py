@@ -1,21 +1,49 @@
 from .footswitch import FootSwitchEventBus
 from .led import LEDController
+from .trace import tracer
+from .listeners import add_listener, remove_listener
+from contextlib import contextmanager
+import weakref
 import Live
 import logging
 
 
 logger = logging.getLogger(__name__)
 
+TRACE_ADD_TRACK = tracer.event("Adding new track {} with name {}")
+TRACE_REMOVE_TRACK = tracer.event("Removing track {}")
+
 class Session:
 	"""
 	Keeps track of all the Tracks in the set. Will call tracks_updated_callback
-	whenever the tracks change
+	whenever the tracks change.
+
+	Updates can be suspended with Session.batch() while tracks are being created
+	or renamed in bulk; each session then reconciles once when the batch ends.
 	"""
+	_suspended = 0
+	_instances = weakref.WeakSet()
+
+	@staticmethod
+	@contextmanager
+	def batch():
+		Session._suspended += 1
+		try:
+			yield
+		finally:
+			Session._suspended -= 1
+			if Session._suspended == 0:
+				for session in list(Session._instances):
+					if session._dirty:
+						session._update_tracks()
+
 	def __init__(self):
+		self._dirty = False
+		Session._instances.add(self)
 		self._tracks = {}
 		self._tracked_tracks = []
 		self._song = Live.Application.get_application().get_document()
-		self._song.add_tracks_listener(self._update_tracks)
+		add_listener(self._song, "tracks", self._update_tracks)
 		self._tracks_updated_callback = None
 		self._update_tracks()
 
@@ -26,18 +54,23 @@ class Session:
 		self._tracks_updated_callback = cb
 
 	def _update_tracks(self):
+		if Session._suspended > 0:
+			self._dirty = True
+			return
+		self._dirty = False
+
 		if len(self._song.tracks) > len(self._tracks):
 			for track in self._song.tracks:
 				if track._live_ptr not in self._tracks:
-					logger.info("Adding new track {} with name {}".format(track._live_ptr, track.name))
+					tracer.trace(TRACE_ADD_TRACK, track._live_ptr, track.name)
 					self._tracks[track._live_ptr] = track
-					track.add_name_listener(self._update_tracks)
+					add_listener(track, "name", self._update_tracks)
 		elif len(self._song.tracks) < len(self._tracks):
 			tracks = {t._live_ptr: t for t in self._song.tracks}
 			for track_ptr in list(self._tracks.keys()):
 				if track_ptr not in tracks:
-					logger.info("Removing track {}".format(track_ptr))
-					del self._tracks[track_ptr]
+					tracer.trace(TRACE_REMOVE_TRACK, track_ptr)
+					remove_listener(self._tracks.pop(track_ptr), "name", self._update_tracks)
 
 		tracked_tracks = [t for t in self._tracks.values() if "#fcb" in t.name]
 		if tracked_tracks != self._tracked_tracks:
@@ -1,7 +1,10 @@
 from .board import Mode
-from .led import LEDController
+from .led import LEDController, PredictedState
 from .footswitch import FootSwitch, Layout, EventType
 from .transport import Metronome
+from .session import Session
+from .listeners import Subscription, add_listener, remove_listener
+from ableton.v2.base import liveobj_valid
 from functools import partial
 import logging
 import threading
@@ -14,8 +17,8 @@ class SessionMode(Mode):
 	Mode for jamming / recording clips in a session.
 
 	This mode will make sure that when the track is set, it has
-	4 tracks immediately to its right, and each of them is taking
-	input from the set track. Like this:
+	N (4 by default) tracks immediately to its right, and each of
+	them is taking input from the set track. Like this:
 
 	[#fcb] [#ch1] [#ch2] [#ch3] [#ch4]
 
@@ -23,32 +26,51 @@ class SessionMode(Mode):
 	Each "#ch" will have monitoring set to Off.
 	Each "#ch" will have its Audio In set to #fcb Post Mixer
 
-	On the top row, there are three stomps. By default these
-	will toggle the first 3 FX in the device chain. Rename
-	devices to include #sesh6 #sesh7 or #sesh8 to override
-	this behavior.
+	If there are more channels than channel pedals, the channels
+	are split into banks and [0] steps through the banks.
 
-	[1]: Play/stop/record #ch1
-	[2]: Play/stop/record #ch2
-	[3]: Play/stop/record #ch3
-	[4]: Play/stop/record #ch4 
+	Each channel records takes into successive scenes. The pedal
+	above a channel's pedal steps back through its earlier takes,
+	or records a new take into the next empty scene when held.
+
+	[1]: Play/stop/record #ch1 | double press to delete take
+	[2]: Play/stop/record #ch2 | double press to delete take
+	[3]: Play/stop/record #ch3 | double press to delete take
+	[4]: Play/stop/record #ch4 | double press to delete take
 	[5]: Tap Tempo | hold to Toggle metronome
-	[6]: Stomp
-	[7]: Stomp
-	[8]: Stomp
-	[9]: Stack [tap / solid] / Erase [hold / blink]
-	[0]: Metronome toggle
+	[6]: Previous #ch1 take | hold for new #ch1 take
+	[7]: Previous #ch2 take | hold for new #ch2 take
+	[8]: Previous #ch3 take | hold for new #ch3 take
+	[9]: Previous #ch4 take | hold for new #ch4 take
+	[0]: Next bank of channels, only when there are more channels than
+	     channel pedals (with the default 4 it does nothing)
 	"""
-	def __init__(self, leds: LEDController, scheduler):
+	def __init__(self, leds: LEDController, scheduler, channels = 4):
 		super(SessionMode, self).__init__(leds)
 		self._leds = leds
 		self._track = None
-		self._tracks_controller = TracksController(leds, scheduler)
+		self._tracks_controller = TracksController(leds, scheduler, channels)
 		self._metronome = Metronome(FootSwitch.FIVE, leds)
 
+	def activate(self):
+		self._metronome.resume()
+		super(SessionMode, self).activate()
+		self._tracks_controller.activate()
+
+	def deactivate(self):
+		self._tracks_controller.deactivate()
+		super(SessionMode, self).deactivate()
+		self._metronome.suspend()
+
+	def set_layout_changed_callback(self, callback):
+		self._tracks_controller.set_layout_changed_callback(callback)
+
 	def set_track(self, track: Live.Track.Track):
 		self._tracks_controller.set_main_track(track)
 
+	def clear(self):
+		self._tracks_controller.clear()
+
 	def get_layout(self):
 		l = Layout()
 		l.union_with(self._tracks_controller.get_layout())
@@ -58,124 +80,387 @@ class SessionMode(Mode):
 
 
 class TracksController:
-	def __init__(self, leds: LEDController, scheduler, size = 4):
+	"""
+	Controls N channel tracks that record from a main track. Each channel gets
+	one of the channel footswitches; with more channels than footswitches,
+	the channels are split into banks and BANK_FOOTSWITCH cycles through them.
+	Every bank draws to its own copy of the LEDs, so only the selected bank
+	shows up on the board.
+	"""
+	CHANNEL_FOOTSWITCHES = [FootSwitch.ONE, FootSwitch.TWO, FootSwitch.THREE, FootSwitch.FOUR]
+	TAKE_FOOTSWITCHES = [FootSwitch.SIX, FootSwitch.SEVEN, FootSwitch.EIGHT, FootSwitch.NINE]
+	BANK_FOOTSWITCH = FootSwitch.TEN
+
+	def __init__(self, leds: LEDController, scheduler, size = 4, footswitches = CHANNEL_FOOTSWITCHES, take_footswitches = TAKE_FOOTSWITCHES):
 		logger.info("Initializing Tracks controller")
 		self._size = size
 		self._scheduler = scheduler
 		self._leds = leds
+		self._footswitches = footswitches
+		self._is_active = False
+		self._layout_changed_callback = None
+		num_banks = (size + len(footswitches) - 1) // len(footswitches)
+		if num_banks == 1:
+			self._bank_leds = [leds]
+		else:
+			self._bank_leds = [leds.copy([fs.led_value() for fs in footswitches]) for _ in range(num_banks)]
+		self._bank = 0
+		self._routing = RoutingResolver(scheduler)
 		self._track_controllers = [
-			TrackController(leds, FootSwitch.ONE, scheduler),
-			TrackController(leds, FootSwitch.TWO, scheduler),
-			TrackController(leds, FootSwitch.THREE, scheduler),
-			TrackController(leds, FootSwitch.FOUR, scheduler),
+			TrackController(
+				self._bank_leds[i // len(footswitches)],
+				footswitches[i % len(footswitches)],
+				scheduler,
+				take_footswitches[i % len(footswitches)] if i % len(footswitches) < len(take_footswitches) else None)
+			for i in range(size)
 		]
 
+	def set_layout_changed_callback(self, callback):
+		self._layout_changed_callback = callback
+
+	def activate(self):
+		self._is_active = True
+		for t in self._track_controllers: t.resume()
+		if len(self._bank_leds) > 1:
+			self._bank_leds[self._bank].activate()
+
+	def deactivate(self):
+		self._is_active = False
+		if len(self._bank_leds) > 1:
+			self._bank_leds[self._bank].deactivate()
+		for t in self._track_controllers: t.suspend()
+
 	def get_layout(self):
 		l = Layout()
-		for t in self._track_controllers: l.union_with(t.get_layout())
+		start = self._bank * len(self._footswitches)
+		for t in self._track_controllers[start:start + len(self._footswitches)]: l.union_with(t.get_layout())
+		if len(self._bank_leds) > 1:
+			l.listen(self.BANK_FOOTSWITCH, EventType.PRESS, self._next_bank)
 		return l
 
+	def _next_bank(self, *a):
+		if self._is_active:
+			self._bank_leds[self._bank].deactivate()
+		self._bank = (self._bank + 1) % len(self._bank_leds)
+		if self._is_active:
+			self._bank_leds[self._bank].activate()
+		if self._layout_changed_callback is not None:
+			self._layout_changed_callback()
+
+	def clear(self):
+		for t in self._track_controllers: t.clear()
+
 	def set_main_track(self, track: Live.Track.Track):
 		logger.info("Setting main track")
 		song = Live.Application.get_application().get_document()
 		tracks = song.tracks
-		for i, main_track in enumerate(tracks):
-			if main_track._live_ptr == track._live_ptr:
-				for j in range(1, self._size + 1):
-					channel_track = None
-					if i + j < len(tracks) and tracks[i + j].name == "ch{}".format(j):
-						channel_track = tracks[i + j]
-					else:
-						channel_track = song.create_audio_track(i + j)
-					channel_track.name = "ch{}".format(j)
-					channel_track.color = main_track.color
-					channel_track.current_monitoring_state = 2 # Monitoring Off
-					channel_track.arm = True
-					channel_track.add_available_input_routing_types_listener(self._set_routing_callback(channel_track, main_track.name))
-					self._track_controllers[j - 1].set_track(channel_track)
-				break
-
-	def _set_routing_callback(self, track: Live.Track.Track, routing):
-		def update_routing():
-			if track.current_input_routing == routing:
-				return
-			for t in track.available_input_routing_types:
-				if t.display_name == routing:
-					def update(typ):
-						def go():
-							track.input_routing_type = typ
-						return go
-					self._scheduler(0, update(t))
-					break
-		return update_routing
+		index = {t._live_ptr: i for i, t in enumerate(tracks)}
+		if track._live_ptr not in index:
+			return
+		i = index[track._live_ptr]
+		main_track = tracks[i]
+
+		existing = 0
+		while existing < self._size and i + existing + 1 < len(tracks) \
+				and tracks[i + existing + 1].name == channel_name(existing + 1):
+			existing += 1
+
+		# Creating and renaming tracks fires the song's track listeners, so
+		# hold them off until every channel is in place.
+		with Session.batch():
+			for j in range(existing + 1, self._size + 1):
+				song.create_audio_track(i + j)
+			tracks = song.tracks
+			for j in range(1, self._size + 1):
+				channel_track = tracks[i + j]
+				channel_track.name = channel_name(j)
+				channel_track.color = main_track.color
+				channel_track.current_monitoring_state = 2 # Monitoring Off
+				channel_track.arm = True
+				self._routing.set_input_routing(channel_track, main_track.name)
+				self._track_controllers[j - 1].set_track(channel_track)
+
+class RoutingResolver:
+	"""
+	Keeps the input routing of tracks pointed at a source by display name.
+
+	The display name -> routing type lookup is cached per track and only
+	rebuilt when that track's available input routings change. Routing
+	changes are collected and applied together in a single scheduled call.
+	"""
+	def __init__(self, scheduler):
+		self._scheduler = scheduler
+		self._tracks = {}
+		self._listeners = {}
+		self._routings = {}
+		self._wanted = {}
+		self._pending = set()
+		self._scheduled = False
+
+	def set_input_routing(self, track: Live.Track.Track, display_name: str):
+		ptr = track._live_ptr
+		if ptr not in self._listeners:
+			self._listeners[ptr] = partial(self._available_routings_changed, ptr)
+			add_listener(track, "available_input_routing_types", self._listeners[ptr])
+		self._tracks[ptr] = track
+		self._wanted[ptr] = display_name
+		self._request(ptr)
+
+	def _available_routings_changed(self, ptr):
+		self._routings.pop(ptr, None)
+		self._request(ptr)
+
+	def _request(self, ptr):
+		self._pending.add(ptr)
+		if not self._scheduled:
+			self._scheduled = True
+			self._scheduler(0, self._apply)
+
+	def _apply(self):
+		self._scheduled = False
+		pending, self._pending = self._pending, set()
+		for ptr in pending:
+			track = self._tracks[ptr]
+			if not liveobj_valid(track):
+				self._forget(ptr)
+				continue
+			display_name = self._wanted[ptr]
+			if track.input_routing_type.display_name == display_name:
+				continue
+			routing = self._lookup(ptr, track).get(display_name)
+			if routing is not None:
+				track.input_routing_type = routing
+
+	def _lookup(self, ptr, track):
+		if ptr not in self._routings:
+			self._routings[ptr] = {t.display_name: t for t in track.available_input_routing_types}
+		return self._routings[ptr]
+
+	def _forget(self, ptr):
+		if ptr in self._listeners:
+			remove_listener(self._tracks[ptr], "available_input_routing_types", self._listeners[ptr])
+		for d in (self._tracks, self._listeners, self._routings, self._wanted):
+			d.pop(ptr, None)
 
 class TrackController:
 	"""
-	Controls a single Track
+	Controls a single Track. The channel footswitch plays/stops/records
+	the selected take (clip slot). Holding the take footswitch records a
+	new take into the first empty scene, and pressing it steps back
+	through the earlier takes.
+
+	The LED shows the state a launch is expected to lead to straight away,
+	and is corrected if Live ends up somewhere else.
 	"""
-	def __init__(self, leds: LEDController, footswitch: FootSwitch, scheduler):
+	# LED states
+	OFF 	= 0
+	ON 		= 1
+	BLINK 	= 2
+
+	def __init__(self, leds: LEDController, footswitch: FootSwitch, scheduler, take_footswitch: FootSwitch = None):
 		self._footswitch = footswitch
+		self._take_footswitch = take_footswitch
 		self._leds = leds
 		self._track = None
-		self._clip_slot = None
-		self._clip = None
+		self._slots = FreeSlotIndex()
+		self._slot_listeners = []
+		self._selected = 0
+		self._playing = Subscription("playing_status", self._update_led)
+		self._led_state = PredictedState(self._clip_state, self._draw, leds.prediction_expiry())
 		self._scheduler = scheduler
 
 	def set_track(self, track: Live.Track.Track):
+		self._clear_track()
 		self._track = track
-		self.update()
+		add_listener(self._track, "clip_slots", self._slots_changed)
+		self._slots_changed()
 
 	def get_layout(self):
 		l = Layout()
 		l.listen(self._footswitch, EventType.DOWN, self._footswitch_down)
 		l.listen(self._footswitch, EventType.DOUBLE_PRESS, self._double_press)
+		if self._take_footswitch is not None:
+			l.listen(self._take_footswitch, EventType.PRESS, self._previous_take)
+			l.listen(self._take_footswitch, EventType.LONG_PRESS, self._new_take)
 		return l
 
 	def _footswitch_down(self, *a):
-		self._clip_slot.fire()
+		self._fire_selected()
+
+	def _fire_selected(self):
+		slot = self._selected_slot()
+		if slot is not None:
+			self._led_state.predict(self.ON)
+			slot.fire()
 
 	def _double_press(self, *a):
-		if self._clip_slot.has_clip:
+		slot = self._selected_slot()
+		if slot is not None and slot.has_clip:
 			self._scheduler(0, self._delete_clip)
 
 	def _delete_clip(self):
-		if self._clip_slot.has_clip:
-			self._clip_slot.set_fire_button_state(False)
-			self._clip_slot.delete_clip()
+		slot = self._selected_slot()
+		if slot is not None and slot.has_clip:
+			slot.set_fire_button_state(False)
+			slot.delete_clip()
+
+	def _previous_take(self, *a):
+		ind = self._slots.previous(self._selected)
+		if ind is None:
+			ind = self._slots.last()
+		if ind is None or ind == self._selected:
+			return
+		self._select(ind)
+		self._fire_selected()
+
+	def _new_take(self, *a):
+		ind = self._slots.first_free()
+		if ind is None:
+			self._scheduler(0, self._new_scene_take)
+			return
+		self._select(ind)
+		self._fire_selected()
+
+	def _new_scene_take(self):
+		if self._track is None:
+			return
+		Live.Application.get_application().get_document().create_scene(-1)
+		if self._slots.first_free() is None:
+			self._slots_changed()
+		ind = self._slots.first_free()
+		if ind is not None:
+			self._select(ind)
+			self._fire_selected()
+
+	def _selected_slot(self):
+		if self._track is None or self._selected >= len(self._slot_listeners):
+			return None
+		return self._slot_listeners[self._selected][0]
+
+	def _select(self, ind):
+		self._selected = ind
+		self._update_clip()
+
+	def _slots_changed(self):
+		# keep the selected take while its slot is still there (e.g. a scene was added)
+		selected = self._selected_slot()
+		if not liveobj_valid(selected):
+			selected = None
+		self._unlisten_slots()
+		slots = self._track.clip_slots
+		keep = None
+		for ind, slot in enumerate(slots):
+			cb = partial(self._has_clip_changed, ind)
+			add_listener(slot, "has_clip", cb)
+			self._slot_listeners.append((slot, cb))
+			if selected is not None and slot == selected:
+				keep = ind
+		self._slots.reset([slot.has_clip for slot in slots])
+		if keep is None:
+			keep = self._slots.last()
+		self._select(keep if keep is not None else 0)
+
+	def _has_clip_changed(self, ind):
+		self._slots.set(ind, self._slot_listeners[ind][0].has_clip)
+		if ind == self._selected:
+			self._update_clip()
+
+	def _unlisten_slots(self):
+		for slot, cb in self._slot_listeners:
+			remove_listener(slot, "has_clip", cb)
+		self._slot_listeners = []
+
+	def clear(self):
+		self._clear_track()
+		self._update_led()
 
-	def update(self):
+	def _clear_track(self):
 		if self._track is not None:
-			self._clip_slot = self._track.clip_slots[0]
-			self._clip_slot.add_has_clip_listener(self._update_clip)
+			remove_listener(self._track, "clip_slots", self._slots_changed)
+		self._unlisten_slots()
+		self._watch_clip(None)
+		self._track = None
 
 	def _update_clip(self):
-		if self._track is None:
-			self._clip_slot = None
-			self._clip = None
+		slot = self._selected_slot()
+		if slot is not None and slot.has_clip:
+			self._watch_clip(slot.clip)
 		else:
-			if self._clip_slot.has_clip:
-				self._clip = self._clip_slot.clip
-				self._clip.add_playing_status_listener(self._update_led)
-			else:
-				self._clip = None
+			self._watch_clip(None)
 
 		self._update_led()
 
+	def suspend(self):
+		self._playing.suspend()
+
+	def resume(self):
+		self._playing.resume()
+
+	def _watch_clip(self, clip):
+		self._playing.set_subject(clip)
+
 	def _update_led(self):
-		if self._track is None or self._clip is None:
-			self.off()
-		elif self._clip.is_playing:
-			self.on()
+		self._led_state.update()
+
+	def _clip_state(self):
+		"""ON while the clip plays, records or is launching, BLINK while it's stopped"""
+		if self._track is None:
+			return self.OFF
+		clip = self._playing.subject()
+		if clip is None:
+			slot = self._selected_slot()
+			return self.ON if slot is not None and slot.is_triggered else self.OFF
+		if clip.is_playing or clip.is_triggered:
+			return self.ON
+		return self.BLINK
+
+	def _draw(self, state):
+		if state == self.ON:
+			self._leds.on(self._footswitch.led_value())
+		elif state == self.BLINK:
+			self._leds.blink_on(self._footswitch.led_value())
 		else:
-			self.blink()
+			self._leds.off(self._footswitch.led_value())
+
+class FreeSlotIndex:
+	"""
+	Keeps which clip slots of a track hold clips as a bitmask, so the first
+	empty slot and the take before a given slot are found with a couple of
+	integer operations instead of a scan over the slots.
+	"""
+	def __init__(self):
+		self._all = 0
+		self._occupied = 0
+
+	def reset(self, has_clips):
+		self._all = (1 << len(has_clips)) - 1
+		self._occupied = 0
+		for ind, has_clip in enumerate(has_clips):
+			if has_clip:
+				self._occupied |= 1 << ind
 
+	def set(self, ind, has_clip):
+		if has_clip:
+			self._occupied |= 1 << ind
+		else:
+			self._occupied &= ~(1 << ind)
 
-	def off(self):
-		self._leds.off(self._footswitch.led_value())
+	def first_free(self):
+		free = self._all & ~self._occupied
+		if free == 0:
+			return None
+		return (free & -free).bit_length() - 1
 
-	def on(self):
-		self._leds.on(self._footswitch.led_value())
+	def last(self):
+		if self._occupied == 0:
+			return None
+		return self._occupied.bit_length() - 1
 
-	def blink(self):
-		self._leds.blink_on(self._footswitch.led_value())
+	def previous(self, ind):
+		earlier = self._occupied & ((1 << ind) - 1)
+		if earlier == 0:
+			return None
+		return earlier.bit_length() - 1
 
+def channel_name(channel: int) -> str:
+	return "ch{}".format(channel)
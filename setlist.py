@@ -0,0 +1,316 @@
+from .board import Mode
+from .footswitch import Layout, FootSwitch, EventType, numbered_footswitches
+from .led import LEDController
+from .session import Session
+from .trace import tracer
+from functools import partial
+import logging
+import Live
+
+logger = logging.getLogger(__name__)
+
+TRACE_BUILD_SONG = tracer.event("Built song {} ({} songs)")
+TRACE_DROP_SONG = tracer.event("Dropped song {}")
+TRACE_SELECT_SONG = tracer.event("Selected song {}")
+
+class Setlist:
+	"""
+	The songs of a gig set, one per #fcb track, in set order.
+
+	Every song gets its own instance of each song mode (made by the
+	factories passed in) bound to the song's track. The first song is built
+	straight away and the rest in the background, one per scheduler tick,
+	so racks, parameters and macro layouts are all resolved before they're
+	needed and selecting a song only swaps which instances the board talks
+	to.
+
+	Each instance listens to its own track, so editing a song only touches
+	that song's entry. A song whose track goes away or loses #fcb is
+	dropped, and new #fcb tracks are built in the background.
+
+	Modes whose set_track changes the set itself (SessionMode creates and
+	arms channel tracks) can't be prebuilt without restructuring every
+	song. Their factories go in shared_factories: one instance each, bound
+	to a song's track when the song is selected.
+	"""
+	def __init__(self, scheduler, factories, shared_factories = ()):
+		self._scheduler = scheduler
+		self._modes = [SongModes(factory) for factory in factories] + \
+			[SharedSongMode(factory) for factory in shared_factories]
+		self._songs = []
+		self._built = set()
+		self._current = None
+		self._building = False
+		self._songs_changed_callback = None
+		self._song = Live.Application.get_application().get_document()
+		self._session = Session()
+		self._session.add_callback(self._tracks_updated)
+		self._tracks_updated()
+
+	def modes(self):
+		"""One board mode per factory, each following the selected song"""
+		return self._modes
+
+	def songs(self):
+		return self._songs
+
+	def current(self):
+		"""Index of the selected song, or None"""
+		for ind, track in enumerate(self._songs):
+			if track._live_ptr == self._current:
+				return ind
+		return None
+
+	def set_songs_changed_callback(self, callback):
+		self._songs_changed_callback = callback
+
+	def select(self, ind):
+		if ind >= len(self._songs):
+			return
+		track = self._songs[ind]
+		if track._live_ptr not in self._built:
+			# not built yet, so build it on Live's thread first
+			self._scheduler(0, partial(self._build_and_select, track))
+			return
+		self._select(track)
+
+	def _select(self, track):
+		if track._live_ptr == self._current:
+			return
+		tracer.trace(TRACE_SELECT_SONG, track.name)
+		self._current = track._live_ptr
+		for modes in self._modes:
+			modes.select(self._current)
+		self._songs_changed()
+
+	def _build_and_select(self, track):
+		if track not in self._songs:
+			return
+		self._build(track)
+		self._select(track)
+
+	def _tracks_updated(self):
+		order = {t._live_ptr: i for i, t in enumerate(self._song.tracks)}
+		songs = sorted(self._session.get_tracks(), key=lambda t: order.get(t._live_ptr, len(order)))
+		ptrs = set(t._live_ptr for t in songs)
+		for ptr in [ptr for ptr in self._built if ptr not in ptrs]:
+			tracer.trace(TRACE_DROP_SONG, ptr)
+			self._built.discard(ptr)
+			for modes in self._modes:
+				modes.remove(ptr)
+		self._songs = songs
+		if self._current not in ptrs:
+			self._current = None
+			if len(songs) > 0:
+				self._build(songs[0])
+				self._select(songs[0])
+		self._build_soon()
+		self._songs_changed()
+
+	def _build_soon(self):
+		if self._building:
+			return
+		if all(t._live_ptr in self._built for t in self._songs):
+			return
+		self._building = True
+		self._scheduler(1, self._build_next)
+
+	def _build_next(self):
+		self._building = False
+		for track in self._songs:
+			if track._live_ptr not in self._built:
+				self._build(track)
+				break
+		self._build_soon()
+
+	def _build(self, track):
+		if track._live_ptr in self._built:
+			return
+		for modes in self._modes:
+			modes.build(track)
+		self._built.add(track._live_ptr)
+		tracer.trace(TRACE_BUILD_SONG, track.name, len(self._songs))
+
+	def _songs_changed(self):
+		if self._songs_changed_callback is not None:
+			self._songs_changed_callback()
+
+class SongModes(Mode):
+	"""
+	Stands in for one mode on the board, and hands everything on to the
+	selected song's instance of that mode. The instances of the other songs
+	stay built, with their layouts compiled, but dormant.
+
+	set_track is ignored: each instance is bound to its song's track by
+	the Setlist.
+	"""
+	def __init__(self, factory):
+		super(SongModes, self).__init__(None)
+		self._factory = factory
+		self._modes = {}
+		self._current = None
+		self._is_active = False
+		self._layout_changed_callback = None
+		self._empty_layout = Layout()
+
+	def build(self, track: Live.Track.Track):
+		ptr = track._live_ptr
+		mode = self._factory()
+		mode.set_layout_changed_callback(partial(self._mode_layout_changed, ptr))
+		mode.set_track(track)
+		mode.deactivate()
+		mode.layout()
+		self._modes[ptr] = mode
+
+	def remove(self, ptr):
+		mode = self._modes.pop(ptr, None)
+		if mode is None:
+			return
+		mode.deactivate()
+		mode.clear()
+		if mode is self._current:
+			self._current = None
+			self._layout_changed()
+
+	def select(self, ptr):
+		mode = self._modes.get(ptr)
+		if mode is self._current:
+			return
+		if self._is_active and self._current is not None:
+			self._current.deactivate()
+		self._current = mode
+		if self._is_active and self._current is not None:
+			self._current.activate()
+		self._layout_changed()
+
+	def activate(self):
+		self._is_active = True
+		if self._current is not None:
+			self._current.activate()
+
+	def deactivate(self):
+		self._is_active = False
+		if self._current is not None:
+			self._current.deactivate()
+
+	def set_layout_changed_callback(self, callback):
+		self._layout_changed_callback = callback
+
+	def set_track(self, track: Live.Track.Track):
+		pass
+
+	def get_layout(self):
+		return self.layout()
+
+	def layout(self) -> Layout:
+		if self._current is None:
+			return self._empty_layout
+		return self._current.layout()
+
+	def _mode_layout_changed(self, ptr):
+		mode = self._modes.get(ptr)
+		if mode is None:
+			return
+		mode.invalidate_layout()
+		if mode is self._current:
+			self._layout_changed()
+
+	def _layout_changed(self):
+		if self._layout_changed_callback is not None:
+			self._layout_changed_callback()
+
+class SharedSongMode(SongModes):
+	"""
+	Stands in for one mode on the board like SongModes, but with a single
+	instance that's bound to the selected song's track when the song is
+	selected, so only songs that actually get played are touched.
+	"""
+	def __init__(self, factory):
+		super(SharedSongMode, self).__init__(factory)
+		self._mode = None
+		self._tracks = {}
+		self._selected = None
+
+	def build(self, track: Live.Track.Track):
+		self._tracks[track._live_ptr] = track
+
+	def remove(self, ptr):
+		self._tracks.pop(ptr, None)
+		if ptr == self._selected:
+			self._selected = None
+			self._unbind()
+
+	def select(self, ptr):
+		if ptr == self._selected:
+			return
+		self._selected = ptr
+		track = self._tracks.get(ptr)
+		if track is None:
+			self._unbind()
+			return
+		if self._mode is None:
+			self._mode = self._factory()
+			self._mode.set_layout_changed_callback(self._shared_layout_changed)
+			self._mode.deactivate()
+		self._mode.set_track(track)
+		self._mode.invalidate_layout()
+		if self._current is None:
+			self._current = self._mode
+			if self._is_active:
+				self._current.activate()
+		self._layout_changed()
+
+	def _unbind(self):
+		if self._current is None:
+			return
+		self._current.deactivate()
+		self._current.clear()
+		self._current = None
+		self._layout_changed()
+
+	def _shared_layout_changed(self):
+		self._mode.invalidate_layout()
+		if self._current is self._mode:
+			self._layout_changed()
+
+class SetlistMode(Mode):
+	"""
+	Picks the song. Songs are shown ten at a time.
+
+	[1-9, 0]: Song 1-10 of the page | hold [0] for the next page
+	"""
+	def __init__(self, leds: LEDController, setlist: Setlist):
+		super(SetlistMode, self).__init__(leds)
+		self._leds = leds
+		self._setlist = setlist
+		self._footswitches = numbered_footswitches()
+		self._page = 0
+		self._setlist.set_songs_changed_callback(self._update_leds)
+		self._update_leds()
+
+	def get_layout(self):
+		l = Layout()
+		for ind, footswitch in enumerate(self._footswitches):
+			l.listen(footswitch, EventType.PRESS, partial(self._select, ind))
+		l.listen(FootSwitch.TEN, EventType.LONG_PRESS, self._next_page)
+		return l
+
+	def set_track(self, track: Live.Track.Track):
+		pass
+
+	def _select(self, ind, *a):
+		self._setlist.select(self._page * len(self._footswitches) + ind)
+
+	def _next_page(self, *a):
+		pages = max(1, (len(self._setlist.songs()) + len(self._footswitches) - 1) // len(self._footswitches))
+		self._page = (self._page + 1) % pages
+		self._update_leds()
+
+	def _update_leds(self):
+		start = self._page * len(self._footswitches)
+		current = self._setlist.current()
+		for ind, footswitch in enumerate(self._footswitches):
+			if start + ind == current:
+				self._leds.on(footswitch.led_value())
+			else:
+				self._leds.off(footswitch.led_value())
@@ -0,0 +1,299 @@
+"""
+Snapshots of a Live set's topology, and a stand-in Live to load them into.
+
+export_snapshot(song, path) walks what Session, RacksControllerMode,
+TracksController and the other modes look at (tracks, devices, rack
+chains, parameters with their ranges and values, clip slots, routings)
+and writes it as gzipped JSON. It only reads from the song.
+
+Offline, load() rebuilds the set from a snapshot out of stand-in objects,
+and install() puts a stand-in Live (and the bits of the ableton framework
+this script imports) in sys.modules, so the real modes can be run against
+a production sized set:
+
+	song = snapshot.load("gig.fcbsnap")
+	snapshot.install(song)
+	from fcb.racks_controller import RacksControllerMode
+	...
+
+Nothing in here imports Live, so it can be imported before install().
+"""
+from collections import defaultdict
+import gzip
+import itertools
+import json
+import logging
+import sys
+import types
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_VERSION = 1
+
+def export_snapshot(song, path: str):
+	snapshot = {
+		"version": SNAPSHOT_VERSION,
+		"song": {
+			"tempo": song.tempo,
+			"metronome": bool(song.metronome),
+			"scenes": len(song.scenes),
+		},
+		"tracks": [_export_track(t) for t in song.tracks],
+	}
+	with gzip.open(path, "wt") as f:
+		json.dump(snapshot, f, separators=(",", ":"))
+	logger.info("Wrote snapshot of {} tracks to {}".format(len(snapshot["tracks"]), path))
+
+def _export_track(track):
+	return {
+		"name": track.name,
+		"color": track.color,
+		"arm": bool(track.arm) if track.can_be_armed else False,
+		"monitoring": track.current_monitoring_state if track.can_be_armed else 0,
+		"input": track.input_routing_type.display_name,
+		"inputs": [t.display_name for t in track.available_input_routing_types],
+		"devices": [_export_device(d) for d in track.devices],
+		"slots": [_export_slot(s) for s in track.clip_slots],
+	}
+
+def _export_device(device):
+	exported = {
+		"name": device.name,
+		"class": device.class_name,
+		"type": device.type,
+		"active": bool(device.is_active),
+		"parameters": [[p.name, p.min, p.max, p.value] for p in device.parameters],
+	}
+	if device.can_have_chains:
+		exported["chains"] = [
+			{"name": c.name, "devices": [_export_device(d) for d in c.devices]}
+			for c in device.chains
+		]
+	return exported
+
+def _export_slot(slot):
+	if not slot.has_clip:
+		return 0
+	return 2 if slot.clip.is_playing else 1
+
+def load(path: str):
+	"""Returns a stand-in song rebuilt from the snapshot at path"""
+	with gzip.open(path, "rt") as f:
+		snapshot = json.load(f)
+	if snapshot.get("version") != SNAPSHOT_VERSION:
+		raise RuntimeError("{} is a version {} snapshot, expected {}".format(
+			path, snapshot.get("version"), SNAPSHOT_VERSION))
+	song = Song(**snapshot["song"])
+	song.tracks = [_load_track(t, song) for t in snapshot["tracks"]]
+	return song
+
+def _load_track(track, song):
+	loaded = Track(
+		name=track["name"],
+		color=track["color"],
+		arm=track["arm"],
+		current_monitoring_state=track["monitoring"],
+		input_routing_type=RoutingType(track["input"]),
+		available_input_routing_types=[RoutingType(name) for name in track["inputs"]],
+	)
+	loaded.devices = [_load_device(d) for d in track["devices"]]
+	loaded.clip_slots = [_load_slot(s) for s in track["slots"]]
+	return loaded
+
+def _load_device(device):
+	cls = RackDevice if "chains" in device else Device
+	loaded = cls(
+		name=device["name"],
+		class_name=device["class"],
+		type=device["type"],
+		is_active=device["active"],
+		parameters=[DeviceParameter(name=n, min=lo, max=hi, value=v) for n, lo, hi, v in device["parameters"]],
+	)
+	if "chains" in device:
+		loaded.chains = [
+			Chain(name=c["name"], devices=[_load_device(d) for d in c["devices"]])
+			for c in device["chains"]
+		]
+	return loaded
+
+def _load_slot(state):
+	slot = ClipSlot()
+	if state > 0:
+		slot.clip = Clip(is_playing=state == 2)
+		slot.has_clip = True
+	return slot
+
+class StandIn:
+	"""
+	Base of the stand-in Live objects: plain attributes, plus
+	add_X_listener / remove_X_listener / X_has_listener for any X, with
+	the listeners called when X is assigned a different value.
+	"""
+	_pointers = itertools.count(1)
+
+	def __init__(self, **attributes):
+		object.__setattr__(self, "_listeners", defaultdict(list))
+		object.__setattr__(self, "_live_ptr", next(StandIn._pointers))
+		for name, value in attributes.items():
+			object.__setattr__(self, name, value)
+
+	def __getattr__(self, name):
+		if name.startswith("add_") and name.endswith("_listener"):
+			return self._listeners[name[4:-9]].append
+		if name.startswith("remove_") and name.endswith("_listener"):
+			return self._listeners[name[7:-9]].remove
+		if name.endswith("_has_listener"):
+			listeners = self._listeners[name[:-13]]
+			return lambda cb: cb in listeners
+		raise AttributeError(name)
+
+	def __setattr__(self, name, value):
+		changed = self.__dict__.get(name, _UNSET) != value
+		object.__setattr__(self, name, value)
+		if changed:
+			for listener in list(self._listeners.get(name, ())):
+				listener()
+
+	def __eq__(self, other):
+		return isinstance(other, StandIn) and other._live_ptr == self._live_ptr
+
+	def __hash__(self):
+		return self._live_ptr
+
+	def listener_count(self) -> int:
+		return sum(len(listeners) for listeners in self._listeners.values())
+
+_UNSET = object()
+
+class Song(StandIn):
+	def __init__(self, tempo = 120.0, metronome = False, scenes = 0):
+		super(Song, self).__init__(
+			tracks=[],
+			scenes=[StandIn() for _ in range(scenes)],
+			tempo=tempo,
+			metronome=metronome,
+			is_playing=False,
+			current_song_time=0.0,
+			signature_numerator=4,
+			signature_denominator=4,
+		)
+
+	def create_audio_track(self, index):
+		track = Track(
+			name="Audio",
+			color=0,
+			input_routing_type=RoutingType("Ext. In"),
+			available_input_routing_types=[RoutingType(t.name) for t in self.tracks],
+		)
+		track.clip_slots = [ClipSlot() for _ in self.scenes]
+		tracks = list(self.tracks)
+		tracks.insert(index if index >= 0 else len(tracks), track)
+		self.tracks = tracks
+		return track
+
+	def create_scene(self, index):
+		self.scenes = list(self.scenes) + [StandIn()]
+		for track in self.tracks:
+			track.clip_slots = list(track.clip_slots) + [ClipSlot()]
+
+	def delete_scene(self, index):
+		scenes = list(self.scenes)
+		del scenes[index]
+		self.scenes = scenes
+		for track in self.tracks:
+			slots = list(track.clip_slots)
+			del slots[index]
+			track.clip_slots = slots
+
+	def tap_tempo(self):
+		pass
+
+	def continue_playing(self):
+		self.is_playing = True
+
+	def begin_undo_step(self):
+		pass
+
+	def end_undo_step(self):
+		pass
+
+class Track(StandIn):
+	def __init__(self, **attributes):
+		attributes.setdefault("devices", [])
+		attributes.setdefault("clip_slots", [])
+		attributes.setdefault("arm", False)
+		attributes.setdefault("current_monitoring_state", 1)
+		attributes.setdefault("can_be_armed", True)
+		super(Track, self).__init__(**attributes)
+
+class RoutingType(StandIn):
+	def __init__(self, display_name):
+		super(RoutingType, self).__init__(display_name=display_name)
+
+class Device(StandIn):
+	def __init__(self, **attributes):
+		attributes.setdefault("can_have_chains", False)
+		super(Device, self).__init__(**attributes)
+
+class RackDevice(Device):
+	def __init__(self, **attributes):
+		attributes.setdefault("chains", [])
+		super(RackDevice, self).__init__(**attributes)
+		object.__setattr__(self, "can_have_chains", True)
+
+class Chain(StandIn):
+	pass
+
+class DeviceParameter(StandIn):
+	pass
+
+class ClipSlot(StandIn):
+	def __init__(self):
+		super(ClipSlot, self).__init__(has_clip=False, clip=None, is_triggered=False)
+
+	def fire(self):
+		if self.clip is None:
+			self.clip = Clip(is_playing=True)
+			self.has_clip = True
+		else:
+			self.clip.is_playing = True
+
+	def set_fire_button_state(self, state):
+		pass
+
+	def delete_clip(self):
+		self.clip = None
+		self.has_clip = False
+
+class Clip(StandIn):
+	def __init__(self, is_playing = False):
+		super(Clip, self).__init__(is_playing=is_playing, is_triggered=False, playing_status=int(is_playing))
+
+def install(song):
+	"""Makes `import Live` and the ableton framework imports used here resolve to stand-ins"""
+	application = types.SimpleNamespace(get_document=lambda: song)
+	live = types.ModuleType("Live")
+	live.Application = types.SimpleNamespace(get_application=lambda: application)
+	live.Song = types.SimpleNamespace(Song=Song)
+	live.Track = types.SimpleNamespace(Track=Track)
+	live.Device = types.SimpleNamespace(Device=Device)
+	live.RackDevice = types.SimpleNamespace(RackDevice=RackDevice)
+	live.DeviceParameter = types.SimpleNamespace(DeviceParameter=DeviceParameter)
+	live.Clip = types.SimpleNamespace(Clip=Clip)
+	live.ClipSlot = types.SimpleNamespace(ClipSlot=ClipSlot)
+	live.MidiMap = types.SimpleNamespace(forward_midi_cc=lambda *a: None)
+	sys.modules["Live"] = live
+
+	base = types.ModuleType("ableton.v2.base")
+	base.liveobj_valid = lambda obj: obj is not None
+	dependency = types.ModuleType("ableton.v2.base.dependency")
+	dependency.depends = lambda **k: (lambda f: f)
+	control_surface = types.ModuleType("ableton.v2.control_surface")
+	control_surface.ControlSurface = type("ControlSurface", (), {})
+	for name, module in (
+			("ableton", types.ModuleType("ableton")),
+			("ableton.v2", types.ModuleType("ableton.v2")),
+			("ableton.v2.base", base),
+			("ableton.v2.base.dependency", dependency),
+			("ableton.v2.control_surface", control_surface)):
+		sys.modules.setdefault(name, module)
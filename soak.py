@@ -0,0 +1,254 @@
+"""
+Soak test: hours of simulated gig activity in virtual time.
+
+Runs the real board and modes against a stand-in Live (see snapshot.py),
+either a snapshot of a production set or a small generated one, with a
+VirtualClock driving the gesture, combo, input and LED threads. A random
+but seeded stream of presses, holds, double presses, mode changes, pedal
+sweeps, clips starting and stopping, set edits and deleting the scenes
+takes were recorded into is played in, and a Watchdog samples threads,
+listeners (the script's own count and what the stand-in Live objects
+actually have registered) and the script's memory each simulated minute.
+
+The run fails when a resource ends the second half of the run higher than
+it ever was in the first half by more than its tolerance:
+
+	python -m fcb.soak [snapshot] --hours 4 --seed 1
+
+Like snapshot.py, nothing is imported from the rest of the package until
+the stand-in Live is installed.
+"""
+from . import snapshot
+import argparse
+import logging
+import random
+import sys
+import time
+import tracemalloc
+
+logger = logging.getLogger(__name__)
+
+# Simulated seconds between watchdog samples
+SAMPLE_INTERVAL = 60.0
+
+# How far a resource may end up above its first half peak
+TOLERANCES = {
+	"threads": 2,
+	"listeners": 0,
+	"live_listeners": 0,
+	"memory": 1 << 14,
+}
+
+# Rack macros of the generated set, spec'd for every kind of action
+MACROS = ["Drive #s1pt", "Wah #s5hel", "Volume #s5hel127-64", "Mix #s2ps64", "Tone #s3ht0-100", "Delay #s4pt"]
+
+class SoakFailure(Exception):
+	pass
+
+def generated_song(songs: int = 2, racks: int = 5, scenes: int = 64, macros = MACROS):
+	"""A stand-in set with songs #fcb tracks of racks with the given macros"""
+	song = snapshot.Song(scenes=scenes)
+	tracks = []
+	for s in range(songs):
+		track = snapshot.Track(
+			name="Song {} #fcb".format(s + 1),
+			color=s,
+			input_routing_type=snapshot.RoutingType("Ext. In"),
+			available_input_routing_types=[snapshot.RoutingType("Ext. In")])
+		track.devices = [_rack("Patch {} #rack".format(r + 1), macros) for r in range(racks)]
+		track.clip_slots = [snapshot.ClipSlot() for _ in range(scenes)]
+		tracks.append(track)
+	song.tracks = tracks
+	return song
+
+def _rack(name, macros):
+	parameters = [snapshot.DeviceParameter(name="Device On", min=0.0, max=1.0, value=1.0)]
+	parameters += [snapshot.DeviceParameter(name=m, min=0.0, max=127.0, value=0.0) for m in macros]
+	chain = snapshot.Chain(name="Chain", devices=[
+		snapshot.Device(name="Amp", class_name="Amp", type=2, is_active=True,
+			parameters=[snapshot.DeviceParameter(name="Device On", min=0.0, max=1.0, value=1.0)])])
+	return snapshot.RackDevice(name=name, class_name="AudioEffectGroupDevice", type=2, is_active=True,
+		parameters=parameters, chains=[chain])
+
+def live_listeners(song) -> int:
+	"""Listeners registered on every stand-in object reachable from the song"""
+	total = song.listener_count()
+	for track in song.tracks:
+		total += track.listener_count()
+		for slot in track.clip_slots:
+			total += slot.listener_count()
+			if slot.clip is not None:
+				total += slot.clip.listener_count()
+		devices = list(track.devices)
+		while len(devices) > 0:
+			device = devices.pop()
+			total += device.listener_count()
+			total += sum(p.listener_count() for p in device.parameters)
+			for chain in getattr(device, "chains", []):
+				devices.extend(chain.devices)
+	return total
+
+def soak(song, hours: float = 4.0, seed: int = 0, trace_memory: bool = True):
+	"""Plays hours of activity into song, returns the Watchdog. Raises SoakFailure on growth."""
+	if trace_memory:
+		# before the board is built, or what it holds from the start only shows once it's replaced
+		tracemalloc.start()
+	snapshot.install(song)
+	from .board import Board
+	from .clock import VirtualClock
+	from .effects_mode import EffectsMode
+	from .footswitch import FootSwitchEventBus, numbered_footswitches, switch_to_value, \
+		FootSwitch, CC_BYTE, DOWN_BYTE, UP_BYTE, LEFT_EXPR_BYTE, RIGHT_EXPR_BYTE
+	from .led import LEDController
+	from .loop_mode import LoopMode
+	from .racks_controller import RacksControllerMode
+	from .session_mode import SessionMode
+	from .watchdog import Watchdog
+
+	rng = random.Random(seed)
+	clock = VirtualClock()
+	main_thread = []
+
+	def scheduler(delay, callback):
+		main_thread.append(callback)
+
+	def tick():
+		for _ in range(8):
+			if len(main_thread) == 0:
+				return
+			pending = list(main_thread)
+			del main_thread[:]
+			for callback in pending:
+				callback()
+
+	def step(seconds):
+		clock.settle()
+		tick()
+		clock.advance(seconds)
+		tick()
+
+	def midi(byte2, byte3):
+		bus.midi_callback(CC_BYTE, byte2, byte3)
+		clock.settle()
+
+	def press(footswitch, hold):
+		midi(DOWN_BYTE, switch_to_value(footswitch))
+		step(hold)
+		midi(UP_BYTE, switch_to_value(footswitch))
+
+	leds = LEDController(lambda *a: None, clock=clock)
+	bus = FootSwitchEventBus(clock=clock)
+	board = Board(leds, bus)
+	initialize_off = [f.led_value() for f in numbered_footswitches()]
+	board.add_mode(RacksControllerMode(leds.copy(initialize_off), scheduler))
+	board.add_mode(EffectsMode(leds.copy(initialize_off)))
+	board.add_mode(LoopMode(leds.copy(initialize_off)))
+	board.add_mode(SessionMode(leds.copy(initialize_off), scheduler))
+	step(1.0)
+
+	# the stand-in set grows as takes are recorded into it, and isn't the script's
+	standin = [tracemalloc.Filter(False, snapshot.__file__), tracemalloc.Filter(False, __file__)]
+	watchdog = Watchdog(SAMPLE_INTERVAL, clock, trace_memory, standin)
+	watchdog.watch("live_listeners", lambda: live_listeners(song))
+
+	def random_clip():
+		track = rng.choice(song.tracks)
+		slot = rng.choice(track.clip_slots)
+		if slot.clip is not None:
+			slot.clip.is_playing = not slot.clip.is_playing
+
+	def random_edit():
+		track = rng.choice(song.tracks)
+		if len(track.devices) == 0:
+			return
+		device = rng.choice(track.devices)
+		if rng.random() < 0.5:
+			# rename, and rename back a bit later
+			name = device.name
+			device.name = name + " (edit)"
+			step(0.5)
+			device.name = name
+		else:
+			# duplicate a rack next to it, and delete the copy a bit later
+			copy = _rack(device.name, [p.name for p in device.parameters[1:]])
+			devices = list(track.devices)
+			devices.insert(devices.index(device) + 1, copy)
+			track.devices = devices
+			step(0.5)
+			track.devices = [d for d in track.devices if d is not copy]
+
+	scenes = len(song.scenes)
+	def clear_takes():
+		# delete the scenes takes were recorded into past the set's own
+		while len(song.scenes) > scenes:
+			song.delete_scene(len(song.scenes) - 1)
+
+	def sweep():
+		pedal = rng.choice([LEFT_EXPR_BYTE, RIGHT_EXPR_BYTE])
+		for value in range(0, 128, rng.choice([2, 4, 8])):
+			midi(pedal, value)
+			step(0.01)
+
+	actions = [
+		(40, lambda: press(rng.choice(numbered_footswitches()), rng.uniform(0.05, 0.3))),
+		(8, lambda: press(rng.choice(numbered_footswitches()), rng.uniform(1.0, 2.0))),
+		(6, lambda: (press(rng.choice(numbered_footswitches()), 0.1), step(0.1), press(rng.choice(numbered_footswitches()), 0.1))),
+		(6, lambda: press(rng.choice([FootSwitch.UP, FootSwitch.DOWN]), 0.1)),
+		(10, sweep),
+		(10, random_clip),
+		(4, random_edit),
+		(1, clear_takes),
+	]
+	weights = [w for w, _ in actions]
+
+	started = time.monotonic()
+	end = clock.now() + hours * 3600
+	next_sample = clock.now()
+	while clock.now() < end:
+		rng.choices(actions, weights)[0][1]()
+		step(rng.uniform(0.2, 3.0))
+		if clock.now() >= next_sample:
+			watchdog.sample()
+			next_sample += SAMPLE_INTERVAL
+	logger.info("Soaked {:.1f} simulated hours in {:.0f}s".format(hours, time.monotonic() - started))
+
+	failures = unbounded_growth(watchdog)
+	if len(failures) > 0:
+		raise SoakFailure("; ".join(failures))
+	return watchdog
+
+def unbounded_growth(watchdog, tolerances = TOLERANCES):
+	failures = []
+	for name, tolerance in tolerances.items():
+		history = [value for _, value in watchdog.history(name)]
+		if len(history) < 4:
+			continue
+		half = len(history) // 2
+		first, second = history[:half], history[half:]
+		if second[-1] > max(first) + tolerance:
+			failures.append("{} grew from a peak of {} to {}".format(name, max(first), second[-1]))
+	return failures
+
+def main(argv = None):
+	parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+	parser.add_argument("snapshot", nargs="?", help="snapshot of a set to soak (default: a generated set)")
+	parser.add_argument("--hours", type=float, default=4.0)
+	parser.add_argument("--seed", type=int, default=0)
+	parser.add_argument("--no-memory", action="store_true", help="don't trace memory")
+	args = parser.parse_args(argv)
+	logging.basicConfig(level=logging.INFO)
+	# four racks, so a duplicated one still gets a patch footswitch
+	song = snapshot.load(args.snapshot) if args.snapshot else generated_song(racks=4)
+	try:
+		watchdog = soak(song, args.hours, args.seed, not args.no_memory)
+	except SoakFailure as e:
+		logger.error("Soak failed: {}".format(e))
+		return 1
+	for name in ("threads", "listeners", "live_listeners", "memory"):
+		history = [value for _, value in watchdog.history(name)]
+		if len(history) > 0:
+			logger.info("{}: {} -> {} (peak {})".format(name, history[0], history[-1], max(history)))
+	return 0
+
+if __name__ == "__main__":
+	sys.exit(main())
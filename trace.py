@@ -0,0 +1,61 @@
+from array import array
+from itertools import count
+from time import monotonic
+import logging
+
+logger = logging.getLogger(__name__)
+
+TRACE_SIZE = 2048
+
+class Tracer:
+	"""
+	Fixed-size ring buffer of trace records. Recording a trace stores an event
+	id, a timestamp and up to two argument references in preallocated slots;
+	nothing is formatted until the buffer is rendered, which only happens when
+	it's dumped (on error, or on demand).
+
+	Arguments are kept by reference, so mutable arguments render with the
+	value they have at dump time. Trace ints, strings and Live objects rather
+	than lists that keep changing.
+	"""
+	def __init__(self, size: int = TRACE_SIZE):
+		self._size = size
+		self._events = array("H", [0]) * size
+		self._times = array("d", [0.0]) * size
+		self._first_args = [None] * size
+		self._second_args = [None] * size
+		self._counter = count()
+		self._written = 0
+		self._formats = ["<empty>"]
+
+	def event(self, fmt: str) -> int:
+		"""Register a format string and return the event id to trace it with"""
+		self._formats.append(fmt)
+		return len(self._formats) - 1
+
+	def trace(self, event_id: int, first = None, second = None):
+		n = next(self._counter)
+		i = n % self._size
+		self._events[i] = event_id
+		self._times[i] = monotonic()
+		self._first_args[i] = first
+		self._second_args[i] = second
+		self._written = n + 1
+
+	def render(self):
+		written = self._written
+		start = max(0, written - self._size)
+		lines = []
+		for n in range(start, written):
+			i = n % self._size
+			try:
+				text = self._formats[self._events[i]].format(self._first_args[i], self._second_args[i])
+			except Exception:
+				text = "{} {} {}".format(self._formats[self._events[i]], self._first_args[i], self._second_args[i])
+			lines.append("{:.4f} {}".format(self._times[i], text))
+		return lines
+
+	def dump(self):
+		logger.info("---- trace ({} records) ----\n{}\n----".format(min(self._written, self._size), "\n".join(self.render())))
+
+tracer = Tracer()
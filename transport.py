@@ -1,12 +1,71 @@
-from time import time
-from .footswitch import FootSwitch, Layout, EventType
+from .footswitch import FootSwitch, Layout, EventType, event_time
 from .led import LEDController
+from .clock import system_clock
+from .listeners import Subscription
 import Live
 import logging
 
 
 logger = logging.getLogger(__name__)
 
+# Number of tap intervals the tempo estimate is taken over
+TAP_HISTORY = 8
+
+# Seconds without a tap after which a new tap starts a fresh estimate
+TAP_TIMEOUT = 2
+
+# Live's tempo range
+MIN_TEMPO = 20.0
+MAX_TEMPO = 999.0
+
+class TapTempo:
+	"""
+	Rolling tap tempo estimate. The last TAP_HISTORY intervals are kept in a
+	ring buffer and the tempo is taken from their median, so a single sloppy
+	tap doesn't move it. Each tap is O(1): the window has a fixed size.
+
+	smoothing is the fraction of the way the tempo moves toward each new
+	estimate; 1 jumps straight to it.
+	"""
+	def __init__(self, size: int = TAP_HISTORY, timeout: float = TAP_TIMEOUT, smoothing: float = 1.0):
+		self._intervals = [0.0] * size
+		self._timeout = timeout
+		self._smoothing = smoothing
+		self.reset()
+
+	def reset(self):
+		self._count = 0
+		self._next = 0
+		self._last_tap = None
+		self._tempo = None
+
+	def tap(self, t: float):
+		"""Registers a tap at time t (seconds) and returns the tempo, or None until there's enough taps"""
+		if self._last_tap is not None and t - self._last_tap > self._timeout:
+			self.reset()
+		if self._last_tap is None:
+			self._last_tap = t
+			return None
+
+		self._intervals[self._next] = t - self._last_tap
+		self._next = (self._next + 1) % len(self._intervals)
+		self._count = min(self._count + 1, len(self._intervals))
+		self._last_tap = t
+		if self._count < 2:
+			return None
+
+		window = sorted(self._intervals[:self._count])
+		mid = self._count // 2
+		interval = window[mid] if self._count % 2 else (window[mid - 1] + window[mid]) / 2
+		if interval <= 0:
+			return self._tempo
+		estimate = min(MAX_TEMPO, max(MIN_TEMPO, 60.0 / interval))
+		if self._tempo is None:
+			self._tempo = estimate
+		else:
+			self._tempo += self._smoothing * (estimate - self._tempo)
+		return self._tempo
+
 class Metronome:
 	"""
 	Component that can be used as a tap tempo, and when
@@ -14,14 +73,22 @@ class Metronome:
 	turning on the metronome, it will also make sure that
 	the transport is playing.
 	"""
-	def __init__(self, footswitch: FootSwitch, leds: LEDController):
+	def __init__(self, footswitch: FootSwitch, leds: LEDController, clock = system_clock):
+		self._clock = clock
 		self._song = Live.Application.get_application().get_document()
 		self._leds = leds
 		self._footswitch = footswitch
-		self._song.add_metronome_listener(self._update)
-		self._times = []
+		self._metronome = Subscription("metronome", self._update)
+		self._metronome.set_subject(self._song)
+		self._tap_tempo = TapTempo()
 		self._update()
 
+	def suspend(self):
+		self._metronome.suspend()
+
+	def resume(self):
+		self._metronome.resume()
+
 	def get_layout(self):
 		l = Layout()
 		l.listen(self._footswitch, EventType.DOWN, self.tapped)
@@ -29,13 +96,10 @@ class Metronome:
 		return l
 
 	def tapped(self, *a):
-		t = time()
-		if len(self._times) > 0:
-			if t - self._times[len(self._times) - 1] > 2:
-				self._times = []
-		self._times.append(t)
-		if len(self._times) > 2:
-			self._song.tempo = 120 / (self._times[len(self._times) - 1] - self._times[len(self._times) - 3])
+		# when the tap's MIDI arrived, not when the notifier thread got to it
+		tempo = self._tap_tempo.tap(event_time(self._clock))
+		if tempo is not None:
+			self._song.tempo = tempo
 
 
 	def held(self, *a):
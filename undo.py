@@ -0,0 +1,87 @@
+from .clock import system_clock
+from .metrics import metrics, UNDO_STEPS
+from contextlib import contextmanager
+import logging
+import threading
+import Live
+
+logger = logging.getLogger(__name__)
+
+# An expression burst ends once its pedal has been still this many seconds
+BURST_GAP = 0.3
+
+class UndoGrouper:
+	"""
+	Groups parameter writes into single entries of Live's undo history.
+
+	group() wraps the writes of one gesture (a stomp toggling several macros,
+	a patch change turning racks on and off). burst() is called on every
+	expression write: the first one opens an undo step and it stays open
+	until the pedal has rested for BURST_GAP, so a whole sweep is one entry.
+
+	Groups nest; only the outermost one begins and ends the undo step.
+	"""
+	def __init__(self, song = None, clock = system_clock, burst_gap: float = BURST_GAP):
+		self._song = song
+		self._clock = clock
+		self._burst_gap = burst_gap
+		self._depth = 0
+		self._burst_deadline = None
+		self._lock = threading.RLock()
+		self._wake = None
+
+	@contextmanager
+	def group(self):
+		self._enter()
+		try:
+			yield
+		finally:
+			self._exit()
+
+	def burst(self):
+		with self._lock:
+			if self._burst_deadline is None:
+				self._enter()
+				if self._wake is None:
+					self._wake = self._clock.event()
+					self._clock.start_thread(self.run)
+				self._wake.set()
+			self._burst_deadline = self._clock.now() + self._burst_gap
+
+	def end_burst(self):
+		"""Ends an open burst now, e.g. before the script goes away"""
+		with self._lock:
+			if self._burst_deadline is not None:
+				self._burst_deadline = None
+				self._exit()
+
+	def run(self):
+		while True:
+			with self._lock:
+				deadline = self._burst_deadline
+				if deadline is not None and self._clock.now() >= deadline:
+					self._burst_deadline = None
+					deadline = None
+					self._exit()
+			self._wake.wait(None if deadline is None else max(0, deadline - self._clock.now()))
+			self._wake.clear()
+
+	def _enter(self):
+		with self._lock:
+			self._depth += 1
+			if self._depth == 1:
+				self._get_song().begin_undo_step()
+
+	def _exit(self):
+		with self._lock:
+			self._depth -= 1
+			if self._depth == 0:
+				self._get_song().end_undo_step()
+				metrics.count(UNDO_STEPS)
+
+	def _get_song(self):
+		if self._song is None:
+			self._song = Live.Application.get_application().get_document()
+		return self._song
+
+undo_grouper = UndoGrouper()
@@ -0,0 +1,131 @@
+from .clock import system_clock
+from .metrics import metrics, LISTENERS
+from array import array
+import logging
+import threading
+import traceback
+import tracemalloc
+
+logger = logging.getLogger(__name__)
+
+# Seconds between samples
+WATCHDOG_INTERVAL = 60.0
+
+# Samples taken before a resource's baseline is set
+WARMUP_SAMPLES = 5
+
+# A resource that rose this many samples in a row, past its baseline, is reported
+GROWTH_SAMPLES = 5
+
+# Samples kept per resource
+HISTORY = 1024
+
+class Watchdog:
+	"""
+	Samples resource counts every interval: the number of threads (notifier,
+	blink, timer threads...), the registered Live listeners, and with
+	trace_memory the memory tracemalloc sees allocated. Other resources can
+	be added with watch(), with a sampler returning an int.
+
+	Each resource keeps its last HISTORY samples in arrays allocated up
+	front, and memory leaves out what's allocated in this file, so the
+	watchdog doesn't see itself grow. memory_filters are more
+	tracemalloc.Filters applied to the memory sample.
+
+	A resource gets a baseline once WARMUP_SAMPLES have been taken. When it
+	goes above its baseline and has risen for GROWTH_SAMPLES samples in a
+	row, it's logged and recorded as an anomaly.
+	"""
+	def __init__(self, interval: float = WATCHDOG_INTERVAL, clock = system_clock, trace_memory: bool = False,
+			memory_filters = ()):
+		self._interval = interval
+		self._clock = clock
+		self._samplers = {}
+		self._times = {}
+		self._values = {}
+		self._counts = {}
+		self._baselines = {}
+		self._anomalies = []
+		self._killed = clock.event()
+		self.watch("threads", threading.active_count)
+		self.watch("listeners", lambda: metrics.gauges[LISTENERS])
+		if trace_memory:
+			if not tracemalloc.is_tracing():
+				tracemalloc.start()
+			self._memory_filters = [tracemalloc.Filter(False, __file__), tracemalloc.Filter(False, tracemalloc.__file__)] \
+				+ list(memory_filters)
+			self.watch("memory", self._traced_memory)
+
+	def watch(self, name: str, sampler):
+		self._samplers[name] = sampler
+		self._times[name] = array("d", [0.0]) * HISTORY
+		self._values[name] = array("q", [0]) * HISTORY
+		self._counts[name] = 0
+
+	def start(self):
+		self._clock.start_thread(self.run)
+
+	def stop(self):
+		self._killed.set()
+
+	def run(self):
+		while not self._killed.wait(self._interval):
+			self.sample()
+		logger.info("Watchdog stopped")
+
+	def sample(self):
+		now = self._clock.now()
+		for name, sampler in self._samplers.items():
+			try:
+				value = sampler()
+			except Exception:
+				logger.error("Caught exception sampling {}: {}".format(name, traceback.format_exc()))
+				continue
+			count = self._counts[name]
+			self._times[name][count % HISTORY] = now
+			self._values[name][count % HISTORY] = value
+			self._counts[name] = count + 1
+			if count + 1 == WARMUP_SAMPLES:
+				self._baselines[name] = value
+			self._check(name, count + 1)
+
+	def _traced_memory(self) -> int:
+		snapshot = tracemalloc.take_snapshot().filter_traces(self._memory_filters)
+		return sum(trace.size for trace in snapshot.traces)
+
+	def history(self, name: str):
+		"""(time, value) samples of a resource, oldest first"""
+		if name not in self._counts:
+			return []
+		count = self._counts[name]
+		return [(self._times[name][i % HISTORY], self._values[name][i % HISTORY])
+			for i in range(max(0, count - HISTORY), count)]
+
+	def baseline(self, name: str):
+		return self._baselines.get(name)
+
+	def anomalies(self):
+		"""(time, resource, baseline, value) of every growth streak reported so far"""
+		return list(self._anomalies)
+
+	def _recent(self, name, count, n):
+		"""The n values of a resource up to its count-th sample"""
+		values = self._values[name]
+		return [values[i % HISTORY] for i in range(count - n, count)]
+
+	def _check(self, name, count):
+		if name not in self._baselines or count < WARMUP_SAMPLES + GROWTH_SAMPLES:
+			return
+		recent = self._recent(name, count, GROWTH_SAMPLES + 1)
+		rising = all(b > a for a, b in zip(recent, recent[1:]))
+		if not rising or recent[-1] <= self._baselines[name]:
+			return
+		# report each streak once, when it first reaches GROWTH_SAMPLES
+		if count > WARMUP_SAMPLES + GROWTH_SAMPLES:
+			previous = self._recent(name, count - 1, GROWTH_SAMPLES + 1)
+			if all(b > a for a, b in zip(previous, previous[1:])):
+				return
+		now, value = self._times[name][(count - 1) % HISTORY], recent[-1]
+		self._anomalies.append((now, name, self._baselines[name], value))
+		logger.warning("{} has grown for {} samples in a row: {} -> {} (baseline {})".format(
+			name, GROWTH_SAMPLES, recent[0], value, self._baselines[name]))